@@ -0,0 +1,143 @@
+import os
+import sys
+import math
+import time
+import argparse
+
+# ใช้แค่ส่วน DB ของแอป ไม่ต้อง render รูปหรือเปิด connection ไป LINE
+os.environ.setdefault("IMAGEMAP_PRERENDER", "0")
+os.environ.setdefault("HELP_BADGES", "0")
+os.environ.setdefault("LINE_HTTP_WARM", "0")
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from app import DATABASE_URL, REPAIR_ESTIMATE_MIN_SAMPLES, REPAIR_OTHER_TYPE, db_connection
+
+WATERMARK = "repair_costs"
+# bucket ถัดไปแพงขึ้น 5% ค่ากลาง bucket คลาดจากราคาจริงไม่เกิน ~2.5%
+BUCKET_RATIO = 1.05
+PRICE_STEP = 50
+
+def bucket_price(bucket):
+    return BUCKET_RATIO ** (bucket + 0.5)
+
+def round_price(price):
+    return max(PRICE_STEP, int(round(price / PRICE_STEP)) * PRICE_STEP)
+
+def percentiles(buckets, fractions):
+    # buckets = [(bucket, samples)] เรียงจากถูกไปแพง
+    total = sum(samples for _, samples in buckets)
+    results = []
+    for fraction in fractions:
+        target, seen = max(1, math.ceil(total * fraction)), 0
+        for bucket, samples in buckets:
+            seen += samples
+            if seen >= target:
+                results.append(round_price(bucket_price(bucket)))
+                break
+    return total, results
+
+def aggregate_repair_costs(min_samples=REPAIR_ESTIMATE_MIN_SAMPLES, rebuild=False):
+    started = time.perf_counter()
+    with db_connection() as conn, conn.cursor() as cur:
+        if rebuild:
+            cur.execute("TRUNCATE repair_cost_buckets, repair_cost_estimates")
+            cur.execute("DELETE FROM aggregation_watermarks WHERE name = %s", (WATERMARK,))
+        cur.execute(
+            "INSERT INTO aggregation_watermarks (name, closed_at, ticket_id) VALUES (%s, '-infinity', 0) ON CONFLICT (name) DO NOTHING",
+            (WATERMARK,)
+        )
+        # ล็อกแถว watermark กันรันซ้อนกันสองตัวแล้วนับ ticket ซ้ำ
+        cur.execute("SELECT closed_at, ticket_id FROM aggregation_watermarks WHERE name = %s FOR UPDATE", (WATERMARK,))
+        since = cur.fetchone()
+        cur.execute("""
+            SELECT closed_at, id, count(*) OVER () FROM tickets
+            WHERE kind = 'repair' AND final_cost > 0 AND closed_at IS NOT NULL AND (closed_at, id) > (%s, %s)
+            ORDER BY closed_at DESC, id DESC LIMIT 1
+        """, since)
+        row = cur.fetchone()
+        if row is None:
+            return {"tickets": 0, "keys": 0, "estimates": 0, "seconds": time.perf_counter() - started}
+        until, tickets = row[:2], row[2]
+        # ticket ที่มีหลายอาการนับเข้าทุกอาการ ระดับ "ทุกอาการ" นับครั้งเดียว
+        cur.execute("""
+            WITH fresh AS (
+                SELECT COALESCE(device_type, %(other)s) AS device_type, COALESCE(brand, '') AS brand,
+                       COALESCE(symptom_tags, '{}') AS tags, floor(ln(final_cost) / ln(%(ratio)s))::int AS bucket
+                FROM tickets
+                WHERE kind = 'repair' AND final_cost > 0 AND closed_at IS NOT NULL
+                  AND (closed_at, id) > (%(since_at)s, %(since_id)s) AND (closed_at, id) <= (%(until_at)s, %(until_id)s)
+            ), keyed AS (
+                SELECT device_type, brand, tag AS symptom_tag, bucket FROM fresh, unnest(tags) AS tag WHERE brand <> ''
+                UNION ALL
+                SELECT device_type, '', tag, bucket FROM fresh, unnest(tags) AS tag
+                UNION ALL
+                SELECT device_type, brand, '', bucket FROM fresh WHERE brand <> ''
+            )
+            INSERT INTO repair_cost_buckets (device_type, brand, symptom_tag, bucket, samples)
+            SELECT device_type, brand, symptom_tag, bucket, count(*) FROM keyed GROUP BY 1, 2, 3, 4
+            ON CONFLICT (device_type, brand, symptom_tag, bucket) DO UPDATE SET samples = repair_cost_buckets.samples + EXCLUDED.samples
+            RETURNING device_type, brand, symptom_tag
+        """, {
+            "other": REPAIR_OTHER_TYPE, "ratio": BUCKET_RATIO,
+            "since_at": since[0], "since_id": since[1], "until_at": until[0], "until_id": until[1],
+        })
+        touched = sorted(set(cur.fetchall()))
+        # คำนวณใหม่เฉพาะกลุ่มที่มี ticket ใหม่เข้ามา กลุ่มอื่นใช้ค่าเดิม
+        estimates, too_few = [], []
+        for start in range(0, len(touched), 1000):
+            chunk = touched[start:start + 1000]
+            rows = execute_values(cur, """
+                SELECT b.device_type, b.brand, b.symptom_tag, b.bucket, b.samples
+                FROM repair_cost_buckets b JOIN (VALUES %s) AS k (device_type, brand, symptom_tag)
+                  ON (b.device_type, b.brand, b.symptom_tag) = (k.device_type, k.brand, k.symptom_tag)
+                ORDER BY 1, 2, 3, 4
+            """, chunk, page_size=len(chunk), fetch=True)
+            groups = {}
+            for device_type, brand, tag, bucket, samples in rows:
+                groups.setdefault((device_type, brand, tag), []).append((bucket, samples))
+            for key, buckets in groups.items():
+                total, (low, median, high) = percentiles(buckets, (0.25, 0.5, 0.75))
+                if total >= min_samples:
+                    estimates.append((*key, total, low, median, high))
+                else:
+                    too_few.append(key)
+        if estimates:
+            execute_values(cur, """
+                INSERT INTO repair_cost_estimates (device_type, brand, symptom_tag, samples, low, median, high) VALUES %s
+                ON CONFLICT (device_type, brand, symptom_tag) DO UPDATE SET
+                    samples = EXCLUDED.samples, low = EXCLUDED.low, median = EXCLUDED.median, high = EXCLUDED.high, updated_at = now()
+            """, estimates, page_size=1000)
+        if too_few:
+            execute_values(
+                cur, "DELETE FROM repair_cost_estimates e USING (VALUES %s) AS k (device_type, brand, symptom_tag) "
+                "WHERE (e.device_type, e.brand, e.symptom_tag) = (k.device_type, k.brand, k.symptom_tag)",
+                too_few, page_size=1000
+            )
+        cur.execute(
+            "UPDATE aggregation_watermarks SET closed_at = %s, ticket_id = %s, updated_at = now() WHERE name = %s",
+            (until[0], until[1], WATERMARK)
+        )
+    return {"tickets": tickets, "keys": len(touched), "estimates": len(estimates), "seconds": time.perf_counter() - started}
+
+def main():
+    parser = argparse.ArgumentParser(description="Fold newly closed repair tickets into the repair cost estimate table (run nightly)")
+    parser.add_argument("--min-samples", type=int, default=REPAIR_ESTIMATE_MIN_SAMPLES, help="fewest closed tickets before a group gets an estimate")
+    parser.add_argument("--rebuild", action="store_true", help="drop the histograms and recount every closed ticket, e.g. after correcting final_cost or closed_at of old tickets")
+    args = parser.parse_args()
+
+    if not DATABASE_URL:
+        print("-> Error: ต้องตั้งค่า DATABASE_URL ก่อน")
+        sys.exit(1)
+    print("Aggregating repair costs...")
+    try:
+        result = aggregate_repair_costs(args.min_samples, args.rebuild)
+    except psycopg2.Error as e:
+        print(f"-> Error: {e}")
+        sys.exit(1)
+    print(f"-> {result['tickets']} newly closed tickets in {result['seconds']:.1f}s")
+    print(f"-> {result['keys']} groups updated, {result['estimates']} with at least {args.min_samples} tickets")
+
+if __name__ == "__main__":
+    main()
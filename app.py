@@ -1,15 +1,46 @@
 import os
 import io
-from datetime import datetime
+import base64
+import bisect
+import fcntl
+import hashlib
+import hmac
+import json
+import math
+import queue
+import random
+import re
+import select
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, wraps
+from multiprocessing import resource_tracker, shared_memory
+import psycopg2
 import pytz
+import requests
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
 from dotenv import load_dotenv
-from flask import Flask, request, abort, send_file
-from PIL import Image
+from flask import Flask, request, abort, jsonify
+from PIL import Image, ImageDraw, ImageFont
 
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import HttpClient, RequestsHttpResponse
 from linebot.models import (
-    MessageEvent, TextMessage, ImageMessage, TextSendMessage,
+    TextSendMessage,
     QuickReply, QuickReplyButton, MessageAction, FlexSendMessage,
     BubbleContainer, BoxComponent, TextComponent, SeparatorComponent,
     ImageComponent, ButtonComponent, URIAction, ImagemapSendMessage,
@@ -20,17 +51,2295 @@ from linebot.models import (
 load_dotenv()
 app = Flask(__name__)
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESS_TOKEN")
 CHANNEL_SECRET = os.getenv("CHANNEL_SECRET")
+# เปลี่ยนเป็น fake_line_api.py ตอนทดสอบ เช่น http://127.0.0.1:8089
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me").rstrip("/")
+
+# connection pool ไป api.line.me (keep-alive) และ retry เมื่อเจอ 429/5xx
+LINE_HTTP_POOL_SIZE = int(os.getenv("LINE_HTTP_POOL_SIZE", 10))
+LINE_HTTP_RETRIES = int(os.getenv("LINE_HTTP_RETRIES", 3))
+LINE_HTTP_BACKOFF = float(os.getenv("LINE_HTTP_BACKOFF", 0.5))
+# รอตาม Retry-After ได้ไม่เกินกี่วินาที reply token หมดอายุเร็ว รอนานกว่านี้ไม่มีประโยชน์
+LINE_HTTP_MAX_WAIT = float(os.getenv("LINE_HTTP_MAX_WAIT", 10))
+LINE_HTTP_WARM = int(os.getenv("LINE_HTTP_WARM", 2))
+
+# โหมด ack-fast: /callback ตอบ 200 ทันที แล้วให้ worker pool ประมวลผล event ต่อ
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+# จำนวน lane: event ของผู้ใช้คนเดียวกันจะเข้า lane เดิมเสมอ (ทำงานตามลำดับ) ผู้ใช้ต่างคนทำงานขนานกัน
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+
+# กัน event ซ้ำเมื่อ LINE ส่ง webhook ซ้ำ (redelivery) จำ webhookEventId ไว้ตาม TTL และไม่เกินขนาดหน่วยความจำที่กำหนด
+DEDUPE_TTL = int(os.getenv("DEDUPE_TTL", 600))
+DEDUPE_MAX_BYTES = int(os.getenv("DEDUPE_MAX_BYTES", 8 * 1024 * 1024))
+
+# ฐานข้อมูล PostgreSQL (ไม่บังคับ ถ้าไม่ตั้งค่าจะเก็บทุกอย่างในหน่วยความจำ)
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+# connection ถูกใช้ครบ DB_POOL_MAX แล้ว รอคืนได้นานสุดกี่วินาทีก่อน error
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+
+# session ของผู้ใช้: backend "memory" หรือ "postgres", หมดอายุเมื่อไม่มีการใช้งานเกิน SESSION_TTL วินาที
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_TTL = int(os.getenv("SESSION_TTL", 1800))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 100000))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", 64 * 1024 * 1024))
+# ข้อความอิสระที่เก็บใน session (รายละเอียดซ่อม สินค้า) ยาวได้เท่าช่องข้อความในการ์ดสรุป
+SESSION_TEXT_MAX = int(os.getenv("SESSION_TEXT_MAX", 400))
+
+# backend "shm": ตาราง session ใน shared memory ใช้ร่วมกันทุก worker บนเครื่องเดียว ไม่ต้องมีฐานข้อมูล
+SHM_SESSION_NAME = os.getenv("SHM_SESSION_NAME", "datacom_sessions")
+SHM_SESSION_SLOTS = int(os.getenv("SHM_SESSION_SLOTS", 16384))
+# ข้อความอิสระใน session ตัดที่ SESSION_TEXT_MAX ตัวอักษร (ไทย 3 ไบต์) session ที่ยังเกินช่องจะ error ไม่ถูกเก็บ
+SHM_SESSION_PAYLOAD = int(os.getenv("SHM_SESSION_PAYLOAD", 2048))
+SHM_SESSION_STRIPES = int(os.getenv("SHM_SESSION_STRIPES", 64))
+SHM_SESSION_SWEEP_INTERVAL = int(os.getenv("SHM_SESSION_SWEEP_INTERVAL", 60))
+
+# ticket: รวม insert หลายรายการใน transaction เดียว ทุก TICKET_FLUSH_MS หรือครบ TICKET_BATCH_SIZE
+TICKET_BATCH_SIZE = int(os.getenv("TICKET_BATCH_SIZE", 200))
+TICKET_FLUSH_MS = float(os.getenv("TICKET_FLUSH_MS", 5))
+TICKET_QUEUE_SIZE = int(os.getenv("TICKET_QUEUE_SIZE", 10000))
+
+# รูปแบบรหัสงานซ่อมของ POS (หลังตัดขีด/ช่องว่างและทำเป็นตัวพิมพ์ใหญ่)
+JOB_CODE_PATTERN = os.getenv("JOB_CODE_PATTERN", r"[A-Z]{1,4}\d{3,10}")
+# จำนวนงานสูงสุดที่แสดงต่อเบอร์โทร (carousel ได้ไม่เกิน 12)
+JOB_LOOKUP_LIMIT = int(os.getenv("JOB_LOOKUP_LIMIT", 10))
+# cache ผลตรวจสถานะ ลบรายตัวผ่าน LISTEN job_changes, TTL กันกรณีพลาด notify
+STATUS_CACHE_SIZE = int(os.getenv("STATUS_CACHE_SIZE", 10000))
+STATUS_CACHE_TTL = int(os.getenv("STATUS_CACHE_TTL", 300))
+# แจ้งเตือนเมื่องานเปลี่ยนเป็นสถานะเหล่านี้ (คั่นด้วย ,) รวมการเปลี่ยนภายใน NOTIFY_WINDOW วินาทีเป็นรอบเดียว
+NOTIFY_STATUSES = tuple(status.strip() for status in os.getenv("NOTIFY_STATUSES", "ซ่อมเสร็จ รอรับเครื่อง").split(",") if status.strip())
+NOTIFY_WINDOW = float(os.getenv("NOTIFY_WINDOW", 2))
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", 4))
+# Bloom filter ของเบอร์โทร/รหัสงานที่มีอยู่ ตอบ "ไม่พบ" โดยไม่ต้องถาม DB
+JOB_BLOOM = os.getenv("JOB_BLOOM", "1") == "1"
+JOB_BLOOM_FP_RATE = float(os.getenv("JOB_BLOOM_FP_RATE", 0.01))
+# เผื่อที่ให้ของที่เพิ่มทีละตัวระหว่างรอ rebuild รอบถัดไป (เท่าของจำนวนตอน rebuild)
+JOB_BLOOM_HEADROOM = float(os.getenv("JOB_BLOOM_HEADROOM", 1.5))
+JOB_BLOOM_MIN_CAPACITY = int(os.getenv("JOB_BLOOM_MIN_CAPACITY", 100000))
+
+# ขนาดรูป imagemap ที่ LINE client ขอ (ความกว้าง px) render ไว้ในหน่วยความจำตอนเริ่มแอป หรือครั้งแรกที่ถูกขอ
+IMAGEMAP_SIZES = (1040, 700, 460, 300, 240)
+IMAGEMAP_PRERENDER = os.getenv("IMAGEMAP_PRERENDER", "1") == "1"
+IMAGEMAP_CONFIG = os.getenv("IMAGEMAP_CONFIG", os.path.join(BASE_DIR, "imagemaps.json"))
+# badge สถานะร้านบนรูปช่วยเหลือ: จำนวน variant ที่เก็บไว้ และรอบการ render state ใหม่ (วินาที)
+HELP_BADGES = os.getenv("HELP_BADGES", "1") == "1"
+HELP_BADGE_VARIANTS = int(os.getenv("HELP_BADGE_VARIANTS", "32"))
+HELP_BADGE_REFRESH = float(os.getenv("HELP_BADGE_REFRESH", "60"))
+BUSINESS_HOURS_CONFIG = os.getenv("BUSINESS_HOURS_CONFIG", os.path.join(BASE_DIR, "business_hours.json"))
+# พจนานุกรมประเภทอุปกรณ์/ยี่ห้อ/รุ่น/อาการ สำหรับอ่านข้อความแจ้งซ่อมในครั้งเดียว
+REPAIR_CATALOG = os.getenv("REPAIR_CATALOG", os.path.join(BASE_DIR, "repair_catalog.json"))
+# ช่วงราคาประเมินบนการ์ดแจ้งซ่อม จากตารางที่ aggregate_repair_costs.py คำนวณไว้ทุกคืน
+REPAIR_ESTIMATES = os.getenv("REPAIR_ESTIMATES", "1") == "1"
+REPAIR_ESTIMATE_REFRESH = float(os.getenv("REPAIR_ESTIMATE_REFRESH", 3600))
+REPAIR_ESTIMATE_MIN_SAMPLES = int(os.getenv("REPAIR_ESTIMATE_MIN_SAMPLES", 5))
+# URL สาธารณะของแอป ใช้ประกอบ baseUrl ของ imagemap
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://datacom-chatbot.onrender.com").rstrip("/")
+
+# ================= DATABASE =================
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+# ThreadedConnectionPool ไม่รอ connection ว่าง (PoolError ทันที) ให้ thread ต่อคิวที่ semaphore แทน
+_db_pool_slots = None
+
+def get_db_pool():
+    # connection ที่เปิดก่อน fork ใช้ข้าม process ไม่ได้ สร้าง pool ใหม่ต่อ process
+    global _db_pool, _db_pool_pid, _db_pool_slots
+    if _db_pool_pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool_pid != os.getpid():
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL is not set")
+                _db_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL)
+                _db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+                _db_pool_pid = os.getpid()
+    return _db_pool
+
+@contextmanager
+def db_connection():
+    pool = get_db_pool()
+    slots = _db_pool_slots
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError(f"no database connection free after {DB_POOL_TIMEOUT:g}s (DB_POOL_MAX={DB_POOL_MAX})")
+    try:
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+    finally:
+        slots.release()
+
+def init_db():
+    with open(os.path.join(BASE_DIR, "schema.sql"), encoding="utf-8") as f:
+        ddl = f.read()
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(ddl)
+
+# ================= SESSIONS =================
+class Session:
+    __slots__ = ("user_id", "state", "data", "stored")
+
+    def __init__(self, user_id, state="IDLE", data=None, stored=False):
+        self.user_id = user_id
+        self.state = state
+        self.data = data if data is not None else {}
+        self.stored = stored
+
+    @property
+    def is_idle(self):
+        return self.state == "IDLE" and not self.data
+
+def session_text(text):
+    # การ์ดสรุปแสดงได้ไม่เกินนี้อยู่แล้ว ตัดก่อนเก็บให้ session พอดีช่อง shared memory
+    return text[:SESSION_TEXT_MAX]
+
+class SessionStore:
+    def load(self, user_id):
+        raise NotImplementedError
+
+    def save(self, session):
+        # ผู้ใช้ที่กลับมา IDLE และไม่มีข้อมูลค้าง ไม่ต้องเก็บไว้
+        if session.is_idle:
+            if session.stored:
+                self.delete(session.user_id)
+                session.stored = False
+            return
+        self._write(session)
+        session.stored = True
+
+    def _write(self, session):
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+class MemorySessionStore(SessionStore):
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, ttl, max_entries, max_bytes):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.bytes = 0
+        # user_id -> (expires_at, state, data, size) เรียงจากใช้ล่าสุดน้อยสุดไปมากสุด
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _drop(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry:
+            self.bytes -= entry[3]
+        return entry
+
+    def _expire(self, now):
+        # TTL ต่ออายุทุกครั้งที่ใช้ ลำดับ LRU จึงเป็นลำดับหมดอายุด้วย
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if entry[0] > now:
+                break
+            self._drop(user_id)
+            self.expired += 1
+
+    def load(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return Session(user_id)
+            self.hits += 1
+            self._entries[user_id] = (now + self.ttl,) + entry[1:]
+            self._entries.move_to_end(user_id)
+            return Session(user_id, entry[1], dict(entry[2]), stored=True)
+
+    def _write(self, session):
+        size = len(session.user_id) + len(session.state) + len(encode_json(session.data)) + self.ENTRY_OVERHEAD
+        now = time.monotonic()
+        with self._lock:
+            self._drop(session.user_id)
+            self._entries[session.user_id] = (now + self.ttl, session.state, dict(session.data), size)
+            self.bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, user_id):
+        with self._lock:
+            self._drop(user_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
+
+class PostgresSessionStore(SessionStore):
+    PURGE_EVERY = 1000
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def load(self, user_id):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT state, data FROM bot_sessions WHERE user_id = %s AND updated_at > now() - %s * interval '1 second'",
+                (user_id, self.ttl)
+            )
+            row = cur.fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return Session(user_id)
+            self.hits += 1
+        return Session(user_id, row[0], row[1], stored=True)
+
+    def _write(self, session):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO bot_sessions (user_id, state, data, updated_at) VALUES (%s, %s, %s, now()) "
+                "ON CONFLICT (user_id) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = now()",
+                (session.user_id, session.state, Json(session.data))
+            )
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % self.PURGE_EVERY == 0
+        if purge:
+            self.purge_expired()
+
+    def delete(self, user_id):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM bot_sessions WHERE user_id = %s", (user_id,))
+
+    def purge_expired(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM bot_sessions WHERE updated_at <= now() - %s * interval '1 second'", (self.ttl,))
+            deleted = cur.rowcount
+        with self._lock:
+            self.evictions += deleted
+
+    def stats(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT count(*), coalesce(sum(pg_column_size(bot_sessions.*)), 0) FROM bot_sessions")
+            entries, size = cur.fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "postgres",
+                "entries": entries,
+                "bytes": int(size),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+class SharedMemorySessionStore(SessionStore):
+    # payload เก็บชื่อ state ไว้ด้วย deploy ที่เพิ่ม/ลบ state ไม่ทำให้ session เดิมกลายเป็น state อื่น
+    MAGIC = b"DCSESS02"
+    HEADER = struct.Struct("<8sIII")
+    HEADER_SIZE = 64
+    # key hash, updated_at (epoch), payload length
+    SLOT = struct.Struct("<QdI")
+    EMPTY = 0
+    TOMBSTONE = 1
+
+    def __init__(self, name, slots, payload_size, stripes, ttl, sweep_interval):
+        self.name = name
+        self.stripes = stripes
+        self.per_stripe = slots // stripes
+        self.slots = self.per_stripe * stripes
+        self.payload_size = payload_size
+        self.slot_size = self.SLOT.size + payload_size
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.rejected = 0
+        self.lock_wait = 0.0
+        self._counter_lock = threading.Lock()
+        self._thread_locks = [threading.Lock() for _ in range(stripes)]
+        self._shm = self._attach(self.HEADER_SIZE + self.slots * self.slot_size)
+        self._buf = self._shm.buf
+        self._lock_fd = os.open(os.path.join(tempfile.gettempdir(), f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        self._sweeper_pid = None
+
+    def _attach(self, size):
+        try:
+            shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+            self.HEADER.pack_into(shm.buf, 0, self.MAGIC, self.slots, self.payload_size, self.stripes)
+        except FileExistsError:
+            shm = shared_memory.SharedMemory(name=self.name)
+            deadline = time.monotonic() + 2
+            while True:
+                magic, slots, payload_size, stripes = self.HEADER.unpack_from(shm.buf, 0)
+                if magic == self.MAGIC or time.monotonic() > deadline:
+                    break
+                time.sleep(0.01)
+            if (magic, slots, payload_size, stripes) != (self.MAGIC, self.slots, self.payload_size, self.stripes):
+                raise RuntimeError(f"Shared memory '{self.name}' has a different layout, remove /dev/shm/{self.name} or change SHM_SESSION_NAME")
+        # ไม่ให้ resource_tracker ลบ segment ตอน worker ตัวที่สร้างปิดตัว worker อื่นยังใช้อยู่
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+    @staticmethod
+    def _hash(user_id):
+        h = int.from_bytes(hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).digest(), "little")
+        return h if h > SharedMemorySessionStore.TOMBSTONE else h + 2
+
+    @contextmanager
+    def _locked(self, stripe):
+        started = time.perf_counter()
+        with self._thread_locks[stripe]:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX, 1, stripe)
+            waited = time.perf_counter() - started
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, stripe)
+        with self._counter_lock:
+            self.lock_wait += waited
+
+    def _offset(self, index):
+        return self.HEADER_SIZE + index * self.slot_size
+
+    def _probe(self, h):
+        # open addressing แบบ linear probe ภายใน stripe ของตัวเอง
+        stripe = h % self.stripes
+        base = stripe * self.per_stripe
+        home = (h // self.stripes) % self.per_stripe
+        for i in range(self.per_stripe):
+            yield base + (home + i) % self.per_stripe
+
+    def _find(self, h):
+        free = None
+        for index in self._probe(h):
+            key = self.SLOT.unpack_from(self._buf, self._offset(index))[0]
+            if key == h:
+                return index, free
+            if key == self.EMPTY:
+                return None, free if free is not None else index
+            if key == self.TOMBSTONE and free is None:
+                free = index
+        return None, free
+
+    def _ensure_sweeper(self):
+        if self._sweeper_pid != os.getpid() and self.sweep_interval:
+            self._sweeper_pid = os.getpid()
+            threading.Thread(target=self._sweep_loop, name="shm-session-sweeper", daemon=True).start()
+
+    def load(self, user_id):
+        self._ensure_sweeper()
+        h = self._hash(user_id)
+        stripe = h % self.stripes
+        now = time.time()
+        entry = None
+        expired = False
+        with self._locked(stripe):
+            index, _ = self._find(h)
+            if index is not None:
+                offset = self._offset(index)
+                _, updated_at, length = self.SLOT.unpack_from(self._buf, offset)
+                if updated_at + self.ttl <= now:
+                    self.SLOT.pack_into(self._buf, offset, self.TOMBSTONE, 0.0, 0)
+                    expired = True
+                else:
+                    entry = bytes(self._buf[offset + self.SLOT.size:offset + self.SLOT.size + length])
+                    self.SLOT.pack_into(self._buf, offset, h, now, length)
+        with self._counter_lock:
+            if entry is None:
+                self.misses += 1
+                self.expired += 1 if expired else 0
+                return Session(user_id)
+            self.hits += 1
+        state, data = json.loads(entry)
+        return Session(user_id, state, data, stored=True)
+
+    def _write(self, session):
+        self._ensure_sweeper()
+        payload = encode_json([session.state, session.data])
+        if len(payload) > self.payload_size:
+            # ไม่ตัดข้อมูลลูกค้าเอง ลบ state เก่าทิ้งไม่ให้ worker อื่นทำต่อจากขั้นที่ผ่านไปแล้ว
+            self.delete(session.user_id)
+            with self._counter_lock:
+                self.rejected += 1
+            raise ValueError(f"Session of {session.user_id} ({session.state}) is {len(payload)} bytes, over SHM_SESSION_PAYLOAD={self.payload_size}")
+        h = self._hash(session.user_id)
+        stripe = h % self.stripes
+        evicted = False
+        with self._locked(stripe):
+            index, free = self._find(h)
+            if index is None:
+                index = free
+            if index is None:
+                # stripe เต็ม ทับ entry ที่ไม่ได้ใช้นานที่สุดใน stripe
+                index = min(self._probe(h), key=lambda i: self.SLOT.unpack_from(self._buf, self._offset(i))[1])
+                evicted = True
+            offset = self._offset(index)
+            self._buf[offset + self.SLOT.size:offset + self.SLOT.size + len(payload)] = payload
+            self.SLOT.pack_into(self._buf, offset, h, time.time(), len(payload))
+        if evicted:
+            with self._counter_lock:
+                self.evictions += 1
+
+    def delete(self, user_id):
+        h = self._hash(user_id)
+        with self._locked(h % self.stripes):
+            index, _ = self._find(h)
+            if index is not None:
+                self.SLOT.pack_into(self._buf, self._offset(index), self.TOMBSTONE, 0.0, 0)
+
+    def sweep(self):
+        # ล้าง entry หมดอายุและจัดเรียง stripe ใหม่ ให้ tombstone ไม่สะสมจน probe ยาว
+        removed = 0
+        now = time.time()
+        for stripe in range(self.stripes):
+            with self._locked(stripe):
+                base = stripe * self.per_stripe
+                live = []
+                for index in range(base, base + self.per_stripe):
+                    offset = self._offset(index)
+                    key, updated_at, length = self.SLOT.unpack_from(self._buf, offset)
+                    if key > self.TOMBSTONE:
+                        if updated_at + self.ttl <= now:
+                            removed += 1
+                        else:
+                            live.append((key, updated_at, bytes(self._buf[offset + self.SLOT.size:offset + self.SLOT.size + length])))
+                    if key != self.EMPTY:
+                        self.SLOT.pack_into(self._buf, offset, self.EMPTY, 0.0, 0)
+                for key, updated_at, payload in live:
+                    index = next(i for i in self._probe(key) if self.SLOT.unpack_from(self._buf, self._offset(i))[0] == self.EMPTY)
+                    offset = self._offset(index)
+                    self._buf[offset + self.SLOT.size:offset + self.SLOT.size + len(payload)] = payload
+                    self.SLOT.pack_into(self._buf, offset, key, updated_at, len(payload))
+        with self._counter_lock:
+            self.expired += removed
+        return removed
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Error sweeping shared sessions: {e}")
+
+    def destroy(self):
+        self._buf = None
+        self._shm.close()
+        # register กลับก่อน unlink เพราะ unlink จะ unregister ซ้ำอีกรอบ
+        resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+
+    def stats(self):
+        used = tombstones = 0
+        for index in range(self.slots):
+            key = self.SLOT.unpack_from(self._buf, self._offset(index))[0]
+            if key == self.TOMBSTONE:
+                tombstones += 1
+            elif key != self.EMPTY:
+                used += 1
+        with self._counter_lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "shm",
+                "slots": self.slots,
+                "stripes": self.stripes,
+                "entries": used,
+                "tombstones": tombstones,
+                "bytes": self._shm.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+                "lock_wait_ms": round(self.lock_wait * 1000, 3),
+            }
+
+def create_session_store(backend):
+    if backend == "shm":
+        return SharedMemorySessionStore(
+            SHM_SESSION_NAME, SHM_SESSION_SLOTS, SHM_SESSION_PAYLOAD, SHM_SESSION_STRIPES,
+            SESSION_TTL, SHM_SESSION_SWEEP_INTERVAL
+        )
+    if backend == "postgres":
+        return PostgresSessionStore(SESSION_TTL)
+    if backend == "memory":
+        return MemorySessionStore(SESSION_TTL, SESSION_MAX_ENTRIES, SESSION_MAX_BYTES)
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+
+session_store = create_session_store(SESSION_BACKEND)
+
+# ================= TICKETS =================
+# 2026-01-01T00:00:00Z
+TICKET_EPOCH_MS = 1767225600000
+
+def percentile_ms(samples, fraction):
+    # samples เป็นวินาที
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 3)
+
+def lease_ticket_worker_id():
+    # ทุก process จองเลข worker จาก sequence ใน DB (วน 0-1023) ไม่ซ้ำกันแม้ pid ชนกันหรืออยู่คนละเครื่อง
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT nextval('ticket_worker_seq')")
+        return cur.fetchone()[0]
+
+class SnowflakeIds:
+    # id 64 บิต: เวลา ms 41 บิต | worker 10 บิต | ลำดับ 12 บิต ได้ id ทันทีไม่ต้องรอ DB
+    # (จอง worker id ครั้งเดียวต่อ process)
+    def __init__(self, lease_worker_id):
+        self.lease_worker_id = lease_worker_id
+        self._pid = None
+        self._worker_id = 0
+        self._last_ms = -1
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._worker_id = self.lease_worker_id() & 0x3FF
+                self._pid = os.getpid()
+            ms = max(int(time.time() * 1000) - TICKET_EPOCH_MS, self._last_ms)
+            if ms == self._last_ms:
+                self._seq = (self._seq + 1) & 0xFFF
+                if self._seq == 0:
+                    # ลำดับเต็มใน ms นี้ ยืม ms ถัดไป
+                    ms += 1
+            else:
+                self._seq = 0
+            self._last_ms = ms
+            return (ms << 22) | (self._worker_id << 12) | self._seq
+
+class TicketWriter:
+    RETRIES = 3
+
+    def __init__(self, batch_size=200, flush_interval=0.005, maxsize=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows = 0
+        self.commits = 0
+        self.failed = 0
+        self.collisions = 0
+        self._commit_times = deque(maxlen=1000)
+        self._wait_times = deque(maxlen=1000)
+        self._queue = queue.Queue(maxsize)
+        self._pid = None
+        self._lock = threading.Lock()
+        self._open_repairs = None
+
+    def _ensure_thread(self):
+        # thread ที่สร้างก่อน fork ไม่ตามไปที่ worker ต้องเริ่มใหม่ต่อ process
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(self._queue.maxsize)
+                    threading.Thread(target=self._run, name="ticket-writer", daemon=True).start()
+                    self._pid = os.getpid()
+
+    def submit(self, ticket_id, code, kind, user_id, data, has_image, columns=(None, None, None, None)):
+        # columns = (device_type, brand, model, symptom_tags) ของตั๋วแจ้งซ่อม
+        self._ensure_thread()
+        self._queue.put((ticket_id, code, kind, user_id, Json(data), has_image, time.time(), *columns))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _flush(self, batch):
+        for attempt in range(self.RETRIES):
+            started = time.perf_counter()
+            try:
+                with db_connection() as conn, conn.cursor() as cur:
+                    inserted = execute_values(
+                        cur,
+                        "INSERT INTO tickets (id, code, kind, user_id, data, has_image, created_at, device_type, brand, model, symptom_tags) "
+                        "VALUES %s ON CONFLICT (id) DO NOTHING RETURNING id",
+                        batch, template="(%s, %s, %s, %s, %s, %s, to_timestamp(%s), %s, %s, %s, %s::text[])", page_size=len(batch), fetch=True
+                    )
+                    if inserted:
+                        # ผู้แจ้งได้รับแจ้งเมื่อ ticket เปลี่ยนเป็นสถานะใน NOTIFY_STATUSES เหมือนคนที่ตรวจสถานะไว้
+                        cur.execute(
+                            "INSERT INTO job_watchers (job_code, user_id, notified_status) "
+                            "SELECT code, user_id, status FROM tickets WHERE id = ANY(%s) AND code IS NOT NULL "
+                            "ON CONFLICT (job_code, user_id) DO NOTHING",
+                            ([row[0] for row in inserted],)
+                        )
+                    skipped = {row[0] for row in batch} - {row[0] for row in inserted}
+                    collided = []
+                    if skipped:
+                        # แถวที่ id มีอยู่แล้ว ถ้าเป็นของรอบก่อนที่ commit ไปแล้วก็ข้ามได้ ถ้าเป็นของคนอื่นคือ id ชน
+                        cur.execute("SELECT id, code, user_id FROM tickets WHERE id = ANY(%s)", (list(skipped),))
+                        existing = {row[0]: row[1:] for row in cur.fetchall()}
+                        collided = [row for row in batch if row[0] in skipped and existing.get(row[0]) != (row[1], row[3])]
+            except psycopg2.Error as e:
+                print(f"Error writing {len(batch)} tickets (attempt {attempt + 1}): {e}")
+                time.sleep(0.1 * 2 ** attempt)
+                continue
+            committed = time.time()
+            if collided:
+                with self._lock:
+                    self.collisions += len(collided)
+                for row in collided:
+                    print(f"ERROR ticket id collision, not saved {row[0]} ({row[1]}): kind={row[2]} user={row[3]} data={row[4].adapted}")
+            with self._lock:
+                self.rows += len(batch) - len(collided)
+                self.commits += 1
+                self._commit_times.append(time.perf_counter() - started)
+                self._wait_times.append(committed - batch[0][6])
+            return
+        with self._lock:
+            self.failed += len(batch)
+        for row in batch:
+            print(f"Dropped ticket {row[0]} ({row[1]}): kind={row[2]} user={row[3]} data={row[4].adapted}")
+
+    def join(self):
+        # รอจน ticket ที่ส่งเข้ามาแล้วถูก commit ครบ
+        self._queue.join()
+
+    def refresh_open_repairs(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM tickets WHERE kind = 'repair' AND status = 'received'")
+            self._open_repairs = cur.fetchone()[0]
+
+    def open_repairs(self):
+        # ค่าที่ thread render badge นับไว้ล่าสุด None = ยังไม่เคยนับ
+        return self._open_repairs
+
+    def stats(self):
+        with self._lock:
+            commit_times, wait_times = list(self._commit_times), list(self._wait_times)
+            return {
+                "rows": self.rows,
+                "commits": self.commits,
+                "failed": self.failed,
+                "collisions": self.collisions,
+                "pending": self._queue.qsize(),
+                "rows_per_commit": round(self.rows / self.commits, 2) if self.commits else 0.0,
+                "commit_ms_p50": percentile_ms(commit_times, 0.5),
+                "commit_ms_p99": percentile_ms(commit_times, 0.99),
+                "wait_ms_p99": percentile_ms(wait_times, 0.99),
+            }
+
+ticket_ids = SnowflakeIds(lease_ticket_worker_id)
+ticket_writer = TicketWriter(TICKET_BATCH_SIZE, TICKET_FLUSH_MS / 1000, TICKET_QUEUE_SIZE) if DATABASE_URL else None
+
+CROCKFORD_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+# ตัวตรวจสอบ mod 37 ตามมาตรฐาน Crockford (จับพิมพ์ผิด 1 ตัวและสลับตัวติดกันได้)
+CROCKFORD_CHECK = CROCKFORD_ALPHABET + "*~$=U"
+_CROCKFORD_DECODE = {char: i for i, char in enumerate(CROCKFORD_ALPHABET)}
+_CROCKFORD_DECODE.update({"O": 0, "I": 1, "L": 1})
+# รหัสงานของ POS ต้องไม่ขึ้นต้นด้วย prefix นี้
+TICKET_CODE_PREFIX = "DC"
+
+def encode_ticket_code(number):
+    body = ""
+    rest = number
+    while rest:
+        rest, digit = divmod(rest, 32)
+        body = CROCKFORD_ALPHABET[digit] + body
+    return f"{TICKET_CODE_PREFIX}-{body.rjust(4, '0')}-{CROCKFORD_CHECK[number % 37]}"
+
+def decode_ticket_code(code):
+    # รับแบบไม่มีขีด ตัวพิมพ์ใหญ่แล้ว เช่น "DC7K3PQ" คืนเลข หรือ None ถ้าตัวตรวจสอบไม่ตรง
+    if not code.startswith(TICKET_CODE_PREFIX) or not 5 <= len(code) - len(TICKET_CODE_PREFIX) <= 9:
+        return None
+    number = 0
+    for char in code[len(TICKET_CODE_PREFIX):-1]:
+        digit = _CROCKFORD_DECODE.get(char)
+        if digit is None:
+            return None
+        number = number * 32 + digit
+    return number if CROCKFORD_CHECK[number % 37] == code[-1] else None
+
+class TicketCodeAllocator:
+    # จองเลขจาก ticket_code_seq ทีละช่วง ไม่ต้องถาม DB ทุก ticket
+    # เหลือน้อยกว่า 1/4 ของช่วงจะจองช่วงถัดไปไว้ล่วงหน้าใน thread แยก
+    def __init__(self):
+        self.block_size = 0
+        self.leases = 0
+        self.lease_time_max = 0.0
+        self._pid = None
+        self._blocks = deque()
+        self._leasing = False
+        self._lock = threading.Lock()
+
+    def _lease(self):
+        started = time.perf_counter()
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT nextval('ticket_code_seq'), increment_by FROM pg_sequences "
+                "WHERE schemaname = current_schema() AND sequencename = 'ticket_code_seq'"
+            )
+            start, size = cur.fetchone()
+        with self._lock:
+            self._blocks.append([start, start + size])
+            self.block_size = size
+            self.leases += 1
+            self.lease_time_max = max(self.lease_time_max, time.perf_counter() - started)
+
+    def _prefetch(self):
+        try:
+            self._lease()
+        except psycopg2.Error as e:
+            print(f"Error leasing ticket codes: {e}")
+        finally:
+            self._leasing = False
+
+    def remaining(self):
+        return sum(end - start for start, end in self._blocks)
+
+    def next(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # ช่วงที่จองไว้ก่อน fork ห้ามใช้ซ้ำใน worker หลายตัว
+                self._pid = os.getpid()
+                self._blocks.clear()
+                self._leasing = False
+            if self._blocks and not self._leasing and self.remaining() <= self.block_size // 4:
+                self._leasing = True
+                threading.Thread(target=self._prefetch, name="ticket-code-lease", daemon=True).start()
+        while True:
+            with self._lock:
+                if self._blocks:
+                    block = self._blocks[0]
+                    number = block[0]
+                    block[0] += 1
+                    if block[0] == block[1]:
+                        self._blocks.popleft()
+                    return encode_ticket_code(number)
+            self._lease()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "block_size": self.block_size,
+                "remaining": self.remaining(),
+                "leases": self.leases,
+                "lease_ms_max": round(self.lease_time_max * 1000, 3),
+            }
+
+ticket_codes = TicketCodeAllocator() if DATABASE_URL else None
+
+def create_ticket(kind, user_id, data, has_image):
+    # คืนเลขที่ ticket ทันที การบันทึกลง DB ทำใน thread เขียนแบบรวม commit
+    # ไม่มี DB = ไม่ได้บันทึกที่ไหน คืน None จะได้ไม่โชว์เลขที่ที่ตามหาไม่ได้
+    if ticket_writer is None:
+        return None
+    try:
+        ticket_id = ticket_ids.next()
+    except psycopg2.Error as e:
+        print(f"Error leasing ticket worker id, not saved: kind={kind} user={user_id} data={data}: {e}")
+        return None
+    try:
+        code = ticket_codes.next()
+    except psycopg2.Error as e:
+        # จองเลขไม่ได้ ยังบันทึก ticket ได้ด้วย id ปกติ
+        print(f"Error leasing ticket codes: {e}")
+        code = None
+    columns = repair_columns(data) if kind == "repair" else (None, None, None, None)
+    ticket_writer.submit(ticket_id, code, kind, user_id, data, has_image, columns)
+    return code or str(ticket_id)
+
+# ================= LINE HTTP CLIENT =================
+class _CountingHTTPSConnection(HTTPSConnection):
+    handshakes = 0
+    _lock = threading.Lock()
+
+    def connect(self):
+        super().connect()
+        with _CountingHTTPSConnection._lock:
+            _CountingHTTPSConnection.handshakes += 1
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+class _CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme, https=_CountingHTTPSConnectionPool)
+
+class PooledHttpClient(HttpClient):
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout=HttpClient.DEFAULT_TIMEOUT, pool_size=LINE_HTTP_POOL_SIZE,
+                 retries=LINE_HTTP_RETRIES, backoff=LINE_HTTP_BACKOFF, max_wait=LINE_HTTP_MAX_WAIT):
+        super().__init__(timeout)
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.requests = 0
+        self.retried = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._warmed_pid = None
+        self._new_session()
+
+    def _new_session(self):
+        self.session = requests.Session()
+        self.adapter = _CountingAdapter(pool_connections=2, pool_maxsize=self.pool_size)
+        self.session.mount("https://", self.adapter)
+        self._pid = os.getpid()
+
+    def _retry_delay(self, response, attempt):
+        # full jitter แต่ถ้า LINE ส่ง Retry-After มาให้รออย่างน้อยเท่านั้น
+        delay = random.uniform(0, self.backoff * (2 ** attempt))
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                try:
+                    wait = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError, IndexError, OverflowError):
+                    # header อ่านไม่ออก ใช้ backoff ปกติ
+                    wait = 0.0
+            delay = max(delay, wait)
+        return min(delay, self.max_wait)
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        # socket ที่ได้มาก่อน fork ใช้ร่วมกันข้าม process ไม่ได้
+        if self._pid != os.getpid():
+            self._new_session()
+        if timeout is None:
+            timeout = self.timeout
+        for attempt in range(self.retries + 1):
+            with self._lock:
+                self.requests += 1
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except requests.ConnectionError:
+                if attempt == self.retries:
+                    raise
+                response = None
+            else:
+                if response.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                    return RequestsHttpResponse(response)
+            with self._lock:
+                self.retried += 1
+            time.sleep(self._retry_delay(response, attempt))
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, headers=headers, params=params, stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, headers=headers, data=data, timeout=timeout)
+
+    def warm_once(self, url, count):
+        # worker ถูก fork หลัง import ต้อง warm session ของ process ที่ใช้จริง ทำครั้งแรกที่มี webhook เข้ามา
+        if self._warmed_pid == os.getpid():
+            return
+        with self._lock:
+            if self._warmed_pid == os.getpid():
+                return
+            self._warmed_pid = os.getpid()
+        if self._pid != os.getpid():
+            self._new_session()
+        threading.Thread(target=self.warm, args=(url, count), name="line-http-warm", daemon=True).start()
+
+    def warm(self, url, count):
+        # เปิด connection ล่วงหน้าพร้อมกัน count เส้น ให้ reply แรกไม่ต้องรอ TLS handshake
+        def touch():
+            try:
+                self.session.head(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                print(f"Error warming LINE connection: {e}")
+        if self._pid != os.getpid():
+            self._new_session()
+        threads = [threading.Thread(target=touch, daemon=True) for _ in range(min(count, self.pool_size))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def stats(self):
+        idle = in_use = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            slots = list(pool.pool.queue)
+            idle += sum(1 for conn in slots if conn is not None)
+            in_use += pool.pool.maxsize - len(slots)
+        with self._lock:
+            return {
+                "pool_size": self.pool_size,
+                "idle": idle,
+                "in_use": in_use,
+                "handshakes": _CountingHTTPSConnection.handshakes,
+                "requests": self.requests,
+                "retried": self.retried,
+            }
+
+line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT, http_client=PooledHttpClient)
+
+# ================= WORK QUEUE =================
+class WorkQueue:
+    def __init__(self, maxsize, workers, name="worker"):
+        self.name = name
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        # gunicorn fork worker หลัง import ไปแล้ว thread ของ master ไม่ตามไปด้วย จึงเริ่ม thread ตอนใช้งานครั้งแรกในแต่ละ process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, func, *args):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((time.monotonic(), func, args))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self):
+        while True:
+            enqueued_at, func, args = self.queue.get()
+            wait = time.monotonic() - enqueued_at
+            with self._lock:
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            try:
+                func(*args)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                print(f"Error processing {self.name} job: {e}")
+            finally:
+                with self._lock:
+                    self.processed += 1
+                self.queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "depth": self.queue.qsize(),
+                "capacity": self.queue.maxsize,
+                "workers": self.workers,
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "wait_avg_ms": round(self.wait_total / self.processed * 1000, 3) if self.processed else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+class LaneExecutor:
+    VNODES = 160
+
+    def __init__(self, lanes, maxsize, name="lane"):
+        self.lanes = [WorkQueue(max(1, maxsize // lanes), 1, name=f"{name}-{i}") for i in range(lanes)]
+        # consistent hashing: เพิ่ม/ลดจำนวน lane แล้วผู้ใช้ส่วนใหญ่ยังอยู่ lane เดิม
+        ring = sorted((self._hash(f"{name}-{i}#{v}"), i) for i in range(lanes) for v in range(self.VNODES))
+        self._ring_keys = [h for h, _ in ring]
+        self._ring_lanes = [i for _, i in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def lane_for(self, key):
+        idx = bisect.bisect(self._ring_keys, self._hash(key)) % len(self._ring_keys)
+        return self._ring_lanes[idx]
+
+    def submit(self, key, func, *args):
+        return self.lanes[self.lane_for(key)].submit(func, *args)
+
+    def stats(self):
+        lanes = [lane.stats() for lane in self.lanes]
+        backlog = [s["depth"] for s in lanes]
+        processed = [s["processed"] for s in lanes]
+        total_processed = sum(processed)
+        mean_backlog = sum(backlog) / len(lanes)
+        mean_processed = total_processed / len(lanes)
+        wait_total = sum(s["wait_avg_ms"] * s["processed"] for s in lanes)
+        return {
+            "lanes": len(lanes),
+            "backlog": backlog,
+            "processed": processed,
+            "dropped": sum(s["dropped"] for s in lanes),
+            "failed": sum(s["failed"] for s in lanes),
+            "wait_avg_ms": round(wait_total / total_processed, 3) if total_processed else 0.0,
+            "wait_max_ms": max(s["wait_max_ms"] for s in lanes),
+            # lane ที่หนักที่สุดเทียบกับค่าเฉลี่ย (1.0 = กระจายเท่ากันพอดี)
+            "backlog_imbalance": round(max(backlog) / mean_backlog, 3) if mean_backlog else 1.0,
+            "load_imbalance": round(max(processed) / mean_processed, 3) if mean_processed else 1.0,
+        }
+
+webhook_executor = LaneExecutor(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, name="webhook")
+
+# ================= JOB LOOKUP =================
+THAI_DIGITS = str.maketrans("๐๑๒๓๔๕๖๗๘๙", "0123456789")
+_LOOKUP_SEPARATORS = re.compile(r"[\s\-\.\(\)/_#]+")
+PHONE_RE = re.compile(r"0\d{8,9}")
+JOB_CODE_RE = re.compile(JOB_CODE_PATTERN)
+
+def normalize_lookup(text):
+    # คืน ("phone" | "ticket" | "job" | None, ค่าที่ normalize แล้ว)
+    value = _LOOKUP_SEPARATORS.sub("", unicodedata.normalize("NFKC", text).translate(THAI_DIGITS)).upper()
+    if value.startswith("+66"):
+        value = "0" + value[3:]
+    elif value.startswith("66") and value.isdigit() and len(value) in (10, 11):
+        value = "0" + value[2:]
+    if PHONE_RE.fullmatch(value):
+        return "phone", value
+    if value.startswith(TICKET_CODE_PREFIX):
+        # เลขที่ ticket ที่ตัวตรวจสอบไม่ตรง = พิมพ์ผิด ไม่ต้องถาม DB
+        number = decode_ticket_code(value)
+        return ("ticket", encode_ticket_code(number)) if number is not None else (None, value)
+    if JOB_CODE_RE.fullmatch(value):
+        return "job", value
+    return None, value
+
+# ข้อความที่อาจเป็นเบอร์โทร/รหัสงาน: ตัวเลขไทยหรืออารบิก ตัวอังกฤษ และตัวคั่น ยาว 6-24 ตัว
+# ข้อความภาษาไทยทั่วไปไม่ผ่านตัวนี้ จึงไม่ต้อง normalize
+LOOKUP_CANDIDATE_RE = re.compile(r"[\s0-9๐-๙A-Za-z+\-.()/_#*~$=]{6,24}")
+
+def classify_lookup(text):
+    if not LOOKUP_CANDIDATE_RE.fullmatch(text):
+        return None, text
+    return normalize_lookup(text)
+
+class Job:
+    __slots__ = ("job_code", "device", "status", "updated_at")
+
+    def __init__(self, job_code, device, status, updated_at):
+        self.job_code = job_code
+        self.device = device
+        self.status = status
+        self.updated_at = updated_at
+
+TICKET_KIND_LABELS = {"repair": "แจ้งซ่อม", "org": "คำสั่งซื้อหน่วยงาน", "inquiry": "สอบถามสินค้า"}
+TICKET_STATUS_LABELS = {"received": "รับเรื่องแล้ว รอแอดมินติดต่อกลับ"}
+
+def find_jobs(kind, value, limit=JOB_LOOKUP_LIMIT):
+    with db_connection() as conn, conn.cursor() as cur:
+        if kind == "ticket":
+            cur.execute("SELECT code, kind, data->>'type', status, created_at FROM tickets WHERE code = %s", (value,))
+            return [
+                Job(code, device or TICKET_KIND_LABELS.get(ticket_kind, ticket_kind), TICKET_STATUS_LABELS.get(status, status), created_at)
+                for code, ticket_kind, device, status, created_at in cur.fetchall()
+            ]
+        if kind == "phone":
+            cur.execute(
+                "SELECT job_code, device, status, updated_at FROM jobs WHERE phone = %s ORDER BY updated_at DESC LIMIT %s",
+                (value, limit)
+            )
+        else:
+            cur.execute("SELECT job_code, device, status, updated_at FROM jobs WHERE job_code = %s", (value,))
+        return [Job(*row) for row in cur.fetchall()]
+
+class JobStatusCache:
+    # LRU หน้า find_jobs ใช้ได้เฉพาะตอนที่ listener ฟัง job_changes อยู่ ไม่งั้นอ่าน DB ตรง
+    CHANNEL = "job_changes"
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.invalidations = 0
+        self.notifications = 0
+        self.listening = False
+        self.bloom = None
+        self.bloom_rejects = 0
+        # object ที่มี job_changed(payload) และ listener_connected() เช่น StatusNotifier
+        self.subscribers = []
+        self._entries = OrderedDict()
+        self._version = 0
+        self._lags = deque(maxlen=1000)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.listening = False
+                    self._entries.clear()
+                    threading.Thread(target=self._listen_loop, name="job-status-listener", daemon=True).start()
+                    self._pid = os.getpid()
+
+    def lookup(self, kind, value):
+        self.start()
+        key = (kind, value)
+        now = time.monotonic()
+        with self._lock:
+            bypass = not self.listening
+            if bypass:
+                self.bypassed += 1
+        # ยังไม่ได้ LISTEN query ตรงนอก lock ไม่ให้ request อื่นรอ DB ต่อกัน
+        if bypass:
+            return find_jobs(kind, value)
+        with self._lock:
+            if self.bloom is not None and kind != "ticket" and not self.bloom.might_contain(kind, value):
+                self.bloom_rejects += 1
+                return []
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            version = self._version
+        jobs = find_jobs(kind, value)
+        with self._lock:
+            # มีการลบ cache ระหว่าง query ผลที่ได้อาจเก่าแล้ว ไม่เก็บ
+            if version == self._version and self.listening:
+                self._entries[key] = (now + self.ttl, jobs)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return jobs
+
+    def invalidate(self, payload):
+        if payload.get("reload"):
+            # import ทั้งชุด ล้าง cache ทั้งหมด
+            with self._lock:
+                self._version += 1
+                self.notifications += 1
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+            return
+        keys = [("job", payload["job_code"]), ("ticket", payload["job_code"])] + [("phone", phone) for phone in payload["phones"] if phone]
+        with self._lock:
+            self._version += 1
+            self.notifications += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+            self._lags.append(time.time() - payload["ts"])
+
+    def _listen_loop(self):
+        delay = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.CHANNEL}")
+                with self._lock:
+                    self.listening = True
+                delay = 1
+                for subscriber in self.subscribers:
+                    subscriber.listener_connected()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        payload = json.loads(conn.notifies.pop(0).payload)
+                        self.invalidate(payload)
+                        for subscriber in self.subscribers:
+                            subscriber.job_changed(payload)
+            except (psycopg2.Error, OSError, ValueError, KeyError) as e:
+                print(f"Error listening for job changes: {e}")
+            finally:
+                # ระหว่างหลุดอาจพลาด notify ไป ล้าง cache ทั้งหมด
+                with self._lock:
+                    self.listening = False
+                    self._version += 1
+                    self._entries.clear()
+                if conn is not None:
+                    conn.close()
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            lags = list(self._lags)
+            return {
+                "listening": self.listening,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "bloom_rejects": self.bloom_rejects,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "notifications": self.notifications,
+                "invalidations": self.invalidations,
+                "lag_ms_p50": percentile_ms(lags, 0.5),
+                "lag_ms_p99": percentile_ms(lags, 0.99),
+            }
+
+status_cache = JobStatusCache(STATUS_CACHE_SIZE, STATUS_CACHE_TTL) if DATABASE_URL else None
+
+class BloomFilter:
+    def __init__(self, capacity, fp_rate):
+        self.capacity = max(1, capacity)
+        self.fp_rate = fp_rate
+        self.size = max(64, int(-self.capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # double hashing: ตำแหน่งที่ i = h1 + i * h2
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def estimated_fp_rate(self):
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+class JobBloom:
+    # เบอร์โทรและรหัสงานทุกตัวในตาราง jobs สร้างใหม่ตอน listener ต่อได้และหลัง import_jobs.py
+    # งานที่ insert เพิ่มเข้ามาจาก job_changes ทีละตัว
+    def __init__(self, fp_rate, headroom, min_capacity):
+        self.fp_rate = fp_rate
+        self.headroom = headroom
+        self.min_capacity = min_capacity
+        self.ready = False
+        self.rebuilds = 0
+        self.rebuild_time = 0.0
+        self._filter = None
+        self._building = None
+        self._rebuild_requested = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def might_contain(self, kind, value):
+        bloom = self._filter
+        return not self.ready or f"{kind}:{value}" in bloom
+
+    def _add(self, items):
+        with self._lock:
+            for target in (self._filter, self._building):
+                if target is not None:
+                    for item in items:
+                        target.add(item)
+
+    def job_changed(self, payload):
+        if payload.get("reload"):
+            self._request_rebuild(keep_serving=True)
+        elif payload.get("status") is not None:
+            self._add([f"job:{payload['job_code']}"] + [f"phone:{phone}" for phone in payload["phones"] if phone])
+
+    def listener_connected(self):
+        # ระหว่างหลุดอาจพลาดงานใหม่ไป ห้ามตอบ "ไม่พบ" จนกว่าจะสร้างใหม่เสร็จ
+        self._request_rebuild(keep_serving=False)
+
+    def _request_rebuild(self, keep_serving):
+        if not keep_serving:
+            self.ready = False
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._rebuild_loop, name="job-bloom", daemon=True).start()
+                    self._pid = os.getpid()
+        self._rebuild_requested.set()
+
+    def _rebuild_loop(self):
+        while True:
+            self._rebuild_requested.wait()
+            self._rebuild_requested.clear()
+            try:
+                self.rebuild()
+            except psycopg2.Error as e:
+                print(f"Error rebuilding job bloom filter: {e}")
+
+    def rebuild(self):
+        started = time.perf_counter()
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT count(*), count(phone) FROM jobs")
+                jobs, phones = cur.fetchone()
+            bloom = BloomFilter(max(self.min_capacity, int((jobs + phones) * self.headroom)), self.fp_rate)
+            with self._lock:
+                # งานที่เข้ามาระหว่างอ่านตารางจะถูกเพิ่มลงตัวใหม่ด้วย
+                self._building = bloom
+            try:
+                # named cursor อ่านทีละก้อนจาก server ไม่โหลดทั้งตารางเข้าหน่วยความจำ
+                with conn.cursor(name="job_bloom_rebuild") as cur:
+                    cur.itersize = 50000
+                    cur.execute("SELECT job_code, phone FROM jobs")
+                    for job_code, phone in cur:
+                        bloom.add(f"job:{job_code}")
+                        if phone:
+                            bloom.add(f"phone:{phone}")
+            except Exception:
+                with self._lock:
+                    self._building = None
+                raise
+        with self._lock:
+            self._filter, self._building = bloom, None
+            self.ready = True
+            self.rebuilds += 1
+            self.rebuild_time = time.perf_counter() - started
+
+    def stats(self):
+        bloom = self._filter
+        return {
+            "ready": self.ready,
+            "bytes": len(bloom.bits) if bloom else 0,
+            "hashes": bloom.hashes if bloom else 0,
+            "items": bloom.count if bloom else 0,
+            "capacity": bloom.capacity if bloom else 0,
+            "target_fp_rate": self.fp_rate,
+            "estimated_fp_rate": round(bloom.estimated_fp_rate(), 6) if bloom else None,
+            "rebuilds": self.rebuilds,
+            "rebuild_ms": round(self.rebuild_time * 1000, 3),
+        }
+
+job_bloom = None
+if status_cache and JOB_BLOOM:
+    job_bloom = JobBloom(JOB_BLOOM_FP_RATE, JOB_BLOOM_HEADROOM, JOB_BLOOM_MIN_CAPACITY)
+    status_cache.bloom = job_bloom
+    status_cache.subscribers.append(job_bloom)
+
+# ================= STATUS NOTIFY =================
+class StatusNotifier:
+    # แจ้งผู้ที่เคยตรวจสถานะงานเมื่องานพร้อมรับ ใช้ multicast เป็นกลุ่ม push เฉพาะคนเดียว
+    MULTICAST_MAX = 500
+
+    def __init__(self, statuses, window, concurrency):
+        self.statuses = frozenset(statuses)
+        self.window = window
+        self.senders = WorkQueue(1000, concurrency, name="notify")
+        self.claimed = 0
+        self.multicasts = 0
+        self.pushes = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self._pending = set()
+        self._sweep_all = False
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def _ensure_thread(self):
+        if self._pid != os.getpid():
+            with self._cond:
+                if self._pid != os.getpid():
+                    self._pending = set()
+                    threading.Thread(target=self._run, name="status-notifier", daemon=True).start()
+                    self._pid = os.getpid()
+
+    def job_changed(self, payload):
+        if payload.get("status") in self.statuses and payload.get("status") != payload.get("old_status"):
+            self._ensure_thread()
+            with self._cond:
+                self._pending.add(payload["job_code"])
+                self._cond.notify()
+
+    def listener_connected(self):
+        # ตอนหลุดอาจพลาด notify ไป ตรวจทุกงานที่ยังไม่ได้แจ้ง
+        self._ensure_thread()
+        with self._cond:
+            self._sweep_all = True
+            self._cond.notify()
+
+    def watch(self, user_id, job_codes):
+        # ผู้ใช้เพิ่งเห็นสถานะล่าสุด บันทึกไว้ว่าแจ้งแล้วถึงสถานะนี้
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO job_watchers (job_code, user_id, notified_status) "
+                "SELECT job_code, %s, status FROM jobs WHERE job_code = ANY(%s) "
+                "ON CONFLICT (job_code, user_id) DO UPDATE SET notified_status = EXCLUDED.notified_status",
+                (user_id, list(job_codes))
+            )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._sweep_all:
+                    self._cond.wait()
+            # รอให้การเปลี่ยนที่ตามมาติดๆ (เช่นจาก import) รวมเป็นรอบเดียว
+            time.sleep(self.window)
+            with self._cond:
+                job_codes, self._pending = self._pending, set()
+                sweep_all, self._sweep_all = self._sweep_all, False
+            try:
+                self.dispatch(self.claim(None if sweep_all else sorted(job_codes)))
+            except psycopg2.Error as e:
+                print(f"Error claiming status notifications: {e}")
+
+    def claim(self, job_codes):
+        # หลาย worker ได้ notify เดียวกัน UPDATE ... RETURNING ทำให้แต่ละคนถูกแจ้งครั้งเดียว
+        # งานจาก POS (jobs) และ ticket ที่เปิดผ่าน bot (เลขที่ DC-XXXX-C) แจ้งแบบเดียวกัน
+        sql = (
+            "UPDATE job_watchers w SET notified_status = j.status FROM ("
+            "SELECT job_code, device, status FROM jobs UNION ALL "
+            "SELECT code, COALESCE(device_type, data->>'type'), status FROM tickets WHERE code IS NOT NULL"
+            ") j WHERE w.job_code = j.job_code AND j.status = ANY(%s) AND w.notified_status IS DISTINCT FROM j.status"
+        )
+        params = [list(self.statuses)]
+        if job_codes is not None:
+            sql += " AND j.job_code = ANY(%s)"
+            params.append(job_codes)
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(sql + " RETURNING w.user_id, j.job_code, j.device, j.status", params)
+            rows = cur.fetchall()
+        with self._cond:
+            self.claimed += len(rows)
+        return rows
+
+    def dispatch(self, rows):
+        # งานหลายชิ้นของผู้ใช้คนเดียวรวมเป็นข้อความเดียว แล้วรวมผู้ใช้ที่ได้ข้อความเหมือนกันเป็นกลุ่ม
+        jobs_by_user = {}
+        for user_id, job_code, device, status in rows:
+            jobs_by_user.setdefault(user_id, []).append((job_code, device, status))
+        groups = {}
+        for user_id, jobs in jobs_by_user.items():
+            groups.setdefault(create_ready_message(sorted(jobs)).body, []).append(user_id)
+        for messages, user_ids in groups.items():
+            if len(user_ids) == 1:
+                self._submit("/v2/bot/message/push", user_ids[0], messages, jobs_by_user)
+                continue
+            for i in range(0, len(user_ids), self.MULTICAST_MAX):
+                self._submit("/v2/bot/message/multicast", user_ids[i:i + self.MULTICAST_MAX], messages, jobs_by_user)
+
+    def _submit(self, path, to, messages, jobs_by_user):
+        if self.senders.submit(self._send, path, to, messages):
+            return
+        # แถวถูก claim ไปแล้ว คิวเต็มแปลว่าผู้ใช้กลุ่มนี้จะไม่ได้รับแจ้ง บันทึกไว้ให้ตามแจ้งเองได้
+        user_ids = to if isinstance(to, list) else [to]
+        job_codes = sorted({job[0] for user_id in user_ids for job in jobs_by_user[user_id]})
+        print(f"Error: notify queue full, dropped status notification to {len(user_ids)} users for jobs {', '.join(job_codes)}")
+        with self._cond:
+            self.dropped += len(user_ids)
+
+    def _send(self, path, to, messages):
+        count = len(to) if isinstance(to, list) else 1
+        # key เดียวกันทุกครั้งที่ PooledHttpClient retry ให้ LINE ส่งซ้ำไม่ได้ถ้ารอบก่อนสำเร็จไปแล้ว
+        headers = {"Content-Type": "application/json", "X-Line-Retry-Key": str(uuid.uuid4())}
+        try:
+            line_bot_api._post(path, data=b'{"to":' + encode_json(to) + b',"messages":' + messages + b'}', headers=headers)
+        except LineBotApiError as e:
+            # 409 = key นี้ LINE รับไปแล้วในรอบก่อน ข้อความถึงผู้ใช้แล้ว
+            if e.status_code != 409:
+                print(f"Error sending status notification to {count} users: {e}")
+                with self._cond:
+                    self.failed += count
+                return
+        except requests.RequestException as e:
+            print(f"Error sending status notification to {count} users: {e}")
+            with self._cond:
+                self.failed += count
+            return
+        with self._cond:
+            self.delivered += count
+            if isinstance(to, list):
+                self.multicasts += 1
+            else:
+                self.pushes += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending_jobs": len(self._pending),
+                "claimed": self.claimed,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "multicasts": self.multicasts,
+                "pushes": self.pushes,
+                "senders": self.senders.stats(),
+            }
+
+status_notifier = None
+if status_cache and NOTIFY_STATUSES:
+    status_notifier = StatusNotifier(NOTIFY_STATUSES, NOTIFY_WINDOW, NOTIFY_CONCURRENCY)
+    status_cache.subscribers.append(status_notifier)
+
+# ================= WEBHOOK DECODER =================
+# แทนการ hydrate model ของ SDK (new_from_json_dict + to_snake_case ทุก key)
+# เก็บเฉพาะ field ที่แอปใช้ แต่คงชื่อ attribute แบบเดียวกับ SDK เพื่อให้ handle_message ใช้ได้เหมือนเดิม
+class EventSource:
+    __slots__ = ("type", "user_id")
+
+    def __init__(self, type, user_id):
+        self.type = type
+        self.user_id = user_id
+
+class EventMessage:
+    __slots__ = ("type", "id", "text")
+
+    def __init__(self, type, id, text):
+        self.type = type
+        self.id = id
+        self.text = text
+
+class EventDeliveryContext:
+    __slots__ = ("is_redelivery",)
+
+    def __init__(self, is_redelivery):
+        self.is_redelivery = is_redelivery
+
+class WebhookEvent:
+    __slots__ = ("type", "timestamp", "reply_token", "webhook_event_id", "delivery_context", "source", "message")
+
+    def __init__(self, type, timestamp, reply_token, webhook_event_id, delivery_context, source, message):
+        self.type = type
+        self.timestamp = timestamp
+        self.reply_token = reply_token
+        self.webhook_event_id = webhook_event_id
+        self.delivery_context = delivery_context
+        self.source = source
+        self.message = message
+
+_CHANNEL_SECRET_BYTES = (CHANNEL_SECRET or "").encode("utf-8")
+
+def verify_signature(body, signature):
+    digest = hmac.new(_CHANNEL_SECRET_BYTES, body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest), (signature or "").encode("utf-8"))
+
+def decode_webhook(body):
+    events = []
+    for raw in json.loads(body).get("events", ()):
+        source = raw.get("source") or {}
+        message = raw.get("message")
+        context = raw.get("deliveryContext")
+        events.append(WebhookEvent(
+            raw.get("type"),
+            raw.get("timestamp"),
+            raw.get("replyToken"),
+            raw.get("webhookEventId"),
+            EventDeliveryContext(context.get("isRedelivery", False)) if context else None,
+            EventSource(source.get("type"), source.get("userId")),
+            EventMessage(message.get("type"), message.get("id"), message.get("text")) if message else None,
+        ))
+    return events
+
+# ================= DEDUPE =================
+class EventDeduper:
+    # จำ event id ไว้เฉพาะใน process นี้ redelivery ที่ไปตก worker อื่นหรือหลัง restart จะไม่ถูกกรอง
+    # ค่าประมาณ overhead ของ 1 entry ใน OrderedDict (node + float) ไม่รวมตัว key
+    ENTRY_OVERHEAD = 120
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry_size(self, event_id):
+        return len(event_id) + self.ENTRY_OVERHEAD
+
+    def _evict_front(self):
+        event_id, _ = self._entries.popitem(last=False)
+        self.bytes -= self._entry_size(event_id)
+
+    def seen(self, event_id, is_redelivery):
+        if not event_id:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            # TTL เท่ากันทุก entry ลำดับการใส่จึงเป็นลำดับหมดอายุด้วย ตัดจากหัวได้เลย
+            while self._entries and next(iter(self._entries.values())) <= now:
+                self._evict_front()
+                self.evictions += 1
+            # event ที่ไม่ใช่ redelivery เป็น event ใหม่แน่นอน ไม่ต้องค้น แค่จำไว้
+            if is_redelivery:
+                if event_id in self._entries:
+                    self.hits += 1
+                    return True
+                self.misses += 1
+            elif event_id in self._entries:
+                return False
+            self._entries[event_id] = now + self.ttl
+            self.bytes += self._entry_size(event_id)
+            while self.bytes > self.max_bytes and self._entries:
+                self._evict_front()
+                self.evictions += 1
+            return False
+
+    def forget(self, event_id):
+        # handler ล้มเหลว ให้ redelivery ครั้งถัดไปได้ทำงานใหม่
+        with self._lock:
+            if self._entries.pop(event_id, None) is not None:
+                self.bytes -= self._entry_size(event_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+event_deduper = EventDeduper(DEDUPE_TTL, DEDUPE_MAX_BYTES)
+
+def skip_redelivered(func):
+    @wraps(func)
+    def wrapper(event):
+        context = event.delivery_context
+        if event_deduper.seen(event.webhook_event_id, bool(context and context.is_redelivery)):
+            print(f"Skipped redelivered event {event.webhook_event_id}")
+            return
+        try:
+            return func(event)
+        except Exception:
+            event_deduper.forget(event.webhook_event_id)
+            raise
+    return wrapper
+
+# ================= REPLY =================
+def encode_json(obj):
+    # compact + UTF-8 ตรงๆ ข้อความไทยไม่ถูก escape เป็น \uXXXX ขนาด payload ลดลงราวครึ่ง
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class PreparedReply:
+    __slots__ = ("body",)
+
+    def __init__(self, *messages):
+        self.body = encode_json([message.as_json_dict() for message in messages])
+
+    @classmethod
+    def from_encoded(cls, *encoded_messages):
+        reply = cls.__new__(cls)
+        reply.body = b"[" + b",".join(encoded_messages) + b"]"
+        return reply
+
+def send_reply(reply_token, reply):
+    if not isinstance(reply, PreparedReply):
+        reply = PreparedReply(reply)
+    body = b'{"replyToken":' + encode_json(reply_token) + b',"messages":' + reply.body + b'}'
+    line_bot_api._post("/v2/bot/message/reply", data=body)
+
+# ================= FLEX TEMPLATE =================
+# ขนาด JSON สูงสุดของ bubble ที่ LINE รับได้
+FLEX_BUBBLE_MAX_BYTES = 30 * 1024
+
+class Slot:
+    __slots__ = ("name", "max_len")
+
+    def __init__(self, name, max_len):
+        self.name = name
+        self.max_len = max_len
+
+class RepeatSlot:
+    __slots__ = ("name", "fields", "item", "max_items")
+
+    def __init__(self, name, fields, item, max_items):
+        self.name = name
+        self.fields = fields
+        self.item = item
+        self.max_items = max_items
+
+_SLOT_MARKER = re.compile(rb'"\\u0000(\d+)\\u0000"')
+
+def _clip(value, max_len):
+    value = str(value)
+    return value if len(value) <= max_len else value[:max_len - 1] + "…"
+
+class FlexTemplate:
+    # กรณีแย่สุด 1 ตัวอักษรถูก escape เป็น \uXXXX = 6 bytes
+    MAX_BYTES_PER_CHAR = 6
+
+    def __init__(self, layout, max_bytes=None):
+        slots = []
+
+        def mark(node):
+            if isinstance(node, (Slot, RepeatSlot)):
+                slots.append(node)
+                return f"\x00{len(slots) - 1}\x00"
+            if isinstance(node, dict):
+                return {key: mark(value) for key, value in node.items()}
+            if isinstance(node, list):
+                return [mark(value) for value in node]
+            return node
+
+        # ผลของ split สลับกันระหว่าง literal กับเลข slot: [literal, index, literal, ...]
+        pieces = _SLOT_MARKER.split(encode_json(mark(layout)))
+        self.parts = []
+        self.max_size = 0
+        for i, piece in enumerate(pieces):
+            if i % 2 == 0:
+                if piece:
+                    self.parts.append(piece)
+                    self.max_size += len(piece)
+                continue
+            slot = slots[int(piece)]
+            if isinstance(slot, RepeatSlot):
+                item = FlexTemplate(slot.item)
+                self.parts.append((slot, item))
+                self.max_size += slot.max_items * item.max_size + slot.max_items - 1
+            else:
+                self.parts.append(slot)
+                self.max_size += slot.max_len * self.MAX_BYTES_PER_CHAR + 2
+
+        if max_bytes is not None and self.max_size > max_bytes:
+            raise ValueError(f"Flex template can grow to {self.max_size} bytes, over the {max_bytes} byte limit")
+
+    def render(self, values):
+        out = []
+        for part in self.parts:
+            if part.__class__ is bytes:
+                out.append(part)
+            elif part.__class__ is Slot:
+                out.append(encode_json(_clip(values[part.name], part.max_len)))
+            else:
+                slot, item = part
+                rows = values[slot.name]
+                if not rows or len(rows) > slot.max_items:
+                    raise ValueError(f"Slot '{slot.name}' takes 1-{slot.max_items} rows, got {len(rows)}")
+                out.append(b",".join(item.render(dict(zip(slot.fields, row))) for row in rows))
+        return b"".join(out)
 
-line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(CHANNEL_SECRET)
+# ================= BUSINESS HOURS =================
+WEEKDAY_KEYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+THAI_WEEKDAYS = ("จันทร์", "อังคาร", "พุธ", "พฤหัสบดี", "ศุกร์", "เสาร์", "อาทิตย์")
+THAI_WEEKDAYS_SHORT = ("จ", "อ", "พ", "พฤ", "ศ", "ส", "อา")
+THAI_MONTHS_SHORT = ("ม.ค.", "ก.พ.", "มี.ค.", "เม.ย.", "พ.ค.", "มิ.ย.", "ก.ค.", "ส.ค.", "ก.ย.", "ต.ค.", "พ.ย.", "ธ.ค.")
 
-sessions = {}
-user_data = {}
+def _parse_hhmm(value):
+    hour, minute = value.split(":")
+    return int(hour) * 60 + int(minute)
+
+class BusinessSchedule:
+    # ตารางเวลาเปิด-ปิดร้าน (รายสัปดาห์ + วันหยุดนักขัตฤกษ์ + วันปิดพิเศษ)
+    # คอมไพล์ล่วงหน้าเป็นช่วงเวลาเปิด (epoch) เรียงกัน แล้วค้นด้วย bisect
+    def __init__(self, config, horizon_days=400):
+        self.tz = pytz.timezone(config.get("timezone", "Asia/Bangkok"))
+        self.horizon_days = horizon_days
+        self.weekly = []
+        for key in WEEKDAY_KEYS:
+            hours = config["weekly"].get(key)
+            if hours and _parse_hhmm(hours[0]) >= _parse_hhmm(hours[1]):
+                raise ValueError(f"business hours: เวลาเปิดวัน {key} ต้องก่อนเวลาปิด")
+            self.weekly.append(tuple(hours) if hours else None)
+        self.holidays = dict(config.get("holidays", {}))
+        self.closures = {}
+        for closure in config.get("closures", []):
+            self.closures.setdefault(closure["date"], []).append(closure)
+        self._opens = []
+        self._closes = []
+        self._closed_days = {}
+        self._compiled_until = 0.0
+        self._lock = threading.Lock()
+        self.compile(datetime.now(self.tz).date())
+
+    def _timestamp(self, day, minutes):
+        midnight = self.tz.localize(datetime(day.year, day.month, day.day))
+        return midnight.timestamp() + minutes * 60
+
+    def _day_intervals(self, day):
+        weekday = day.weekday()
+        iso = day.isoformat()
+        holiday = self.holidays.get(iso) or self.holidays.get(iso[5:])
+        if holiday:
+            return [], holiday
+        hours = self.weekly[weekday]
+        if not hours:
+            return [], f"วัน{THAI_WEEKDAYS[weekday]}"
+        intervals = [(_parse_hhmm(hours[0]), _parse_hhmm(hours[1]))]
+        reason = None
+        for closure in self.closures.get(iso, []):
+            # ไม่ระบุ from/until = ปิดทั้งวัน
+            start = _parse_hhmm(closure["from"]) if "from" in closure else 0
+            end = _parse_hhmm(closure["until"]) if "until" in closure else 24 * 60
+            reason = closure.get("reason", "ปิดทำการชั่วคราว")
+            remaining = []
+            for open_at, close_at in intervals:
+                if open_at < start:
+                    remaining.append((open_at, min(close_at, start)))
+                if close_at > end:
+                    remaining.append((max(open_at, end), close_at))
+            intervals = remaining
+        return intervals, None if intervals else reason
+
+    def compile(self, start_day):
+        opens, closes, closed_days = [], [], {}
+        for offset in range(-1, self.horizon_days):
+            day = start_day + timedelta(days=offset)
+            intervals, reason = self._day_intervals(day)
+            if reason:
+                closed_days[day] = reason
+            for open_at, close_at in intervals:
+                opens.append(self._timestamp(day, open_at))
+                closes.append(self._timestamp(day, close_at))
+        with self._lock:
+            self._opens, self._closes, self._closed_days = opens, closes, closed_days
+            # คอมไพล์ใหม่ก่อนตารางหมดหนึ่งสัปดาห์
+            self._compiled_until = self._timestamp(start_day, 0) + (self.horizon_days - 7) * 86400
+
+    def now(self):
+        return datetime.now(self.tz)
+
+    def _ensure(self, ts):
+        if ts > self._compiled_until:
+            self.compile(datetime.fromtimestamp(ts, self.tz).date())
+
+    def is_open(self, now):
+        ts = now.timestamp()
+        self._ensure(ts)
+        i = bisect.bisect_right(self._opens, ts) - 1
+        return i >= 0 and ts < self._closes[i]
+
+    def next_opening(self, now):
+        ts = now.timestamp()
+        self._ensure(ts)
+        i = bisect.bisect_right(self._opens, ts)
+        return datetime.fromtimestamp(self._opens[i], self.tz) if i < len(self._opens) else None
+
+    def closed_reason(self, day):
+        # เหตุผลที่ร้านปิดทั้งวัน หรือ None ถ้าวันนั้นเปิด
+        self._ensure(self._timestamp(day, 0))
+        return self._closed_days.get(day)
+
+    def today_hours(self, now):
+        ts = now.timestamp()
+        self._ensure(ts)
+        day = now.date()
+        start = bisect.bisect_left(self._opens, self._timestamp(day, 0))
+        end = bisect.bisect_left(self._opens, self._timestamp(day + timedelta(days=1), 0))
+        return [
+            (datetime.fromtimestamp(self._opens[i], self.tz), datetime.fromtimestamp(self._closes[i], self.tz))
+            for i in range(start, end)
+        ]
+
+    def weekly_groups(self):
+        # รวมวันที่ติดกันและเวลาเท่ากัน เช่น [(0, 5, ("08:30", "18:30"))]
+        groups = []
+        for weekday, hours in enumerate(self.weekly):
+            if hours and groups and groups[-1][2] == hours and groups[-1][1] == weekday - 1:
+                groups[-1] = (groups[-1][0], weekday, hours)
+            elif hours:
+                groups.append((weekday, weekday, hours))
+        return groups
+
+    def weekly_text(self, short=False):
+        names = THAI_WEEKDAYS_SHORT if short else THAI_WEEKDAYS
+        parts = []
+        for first, last, (open_at, close_at) in self.weekly_groups():
+            days = names[first] if first == last else f"{names[first]}-{names[last]}"
+            parts.append(f"{open_at} - {close_at} น. ({days})" if short else f"{days} เวลา {open_at} - {close_at} น.")
+        return ", ".join(parts)
+
+    def weekly_closed_text(self):
+        return " ".join(f"วัน{THAI_WEEKDAYS[weekday]}" for weekday, hours in enumerate(self.weekly) if not hours)
+
+    def stats(self):
+        return {
+            "intervals": len(self._opens),
+            "closed_days": len(self._closed_days),
+            "compiled_until": datetime.fromtimestamp(self._compiled_until, self.tz).isoformat(),
+        }
+
+def format_thai_datetime(moment):
+    return f"{THAI_WEEKDAYS[moment.weekday()]} {moment.day} {THAI_MONTHS_SHORT[moment.month - 1]} เวลา {moment:%H:%M} น."
+
+def load_business_schedule(path):
+    with open(path, encoding="utf-8") as f:
+        return BusinessSchedule(json.load(f))
+
+business_schedule = load_business_schedule(BUSINESS_HOURS_CONFIG)
+
+# ================= REPAIR PARSER =================
+# ป้ายจากข้อความ prompt แจ้งซ่อม ลูกค้ามักพิมพ์ตามทีละบรรทัดหรือรวมกันในบรรทัดเดียว
+REPAIR_LABELS = {"ยี่ห้อ": "brand", "รุ่น": "model", "อาการที่พบ": "symptom", "อาการ": "symptom"}
+_REPAIR_LABEL_RE = re.compile(r"(ยี่ห้อ|รุ่น|อาการที่พบ|อาการ)\s*[:：]?\s*")
+REPAIR_FIELD_LABELS = {"brand": "ยี่ห้อ", "model": "รุ่น", "symptom": "อาการที่พบ"}
+# ข้อมูลขั้นต่ำที่ช่างต้องใช้ ครบแล้วเปิด ticket ได้เลย (รุ่นถามด้วยถ้ายังต้องถามอย่างอื่น)
+REPAIR_REQUIRED_FIELDS = ("type", "brand", "symptom")
+REPAIR_OTHER_TYPE = "อุปกรณ์อื่น"
+_TRIE_END = ""
+
+def _normalize_repair_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).translate(THAI_DIGITS).lower().split())
+
+def _is_ascii_word(char):
+    return char.isascii() and char.isalnum()
+
+def parse_repair_labels(text):
+    labels = {}
+    for line in text.splitlines():
+        matches = []
+        for match in _REPAIR_LABEL_RE.finditer(line):
+            # คำว่า "อาการ" ในคำบรรยายอาการไม่ใช่ป้ายใหม่
+            if matches and REPAIR_LABELS[matches[-1].group(1)] == "symptom" == REPAIR_LABELS[match.group(1)]:
+                continue
+            matches.append(match)
+        for match, following in zip(matches, matches[1:] + [None]):
+            value = line[match.end():following.start() if following else len(line)].strip(" -:,|/")
+            if value:
+                labels.setdefault(REPAIR_LABELS[match.group(1)], value[:100])
+    return labels
+
+class RepairCatalog:
+    # คอมไพล์ชื่อเรียกทั้งหมดเป็น trie ของตัวอักษร ภาษาไทยไม่เว้นวรรคระหว่างคำ
+    # จึงหาคำที่ยาวที่สุดจากแต่ละตำแหน่งแทนการตัดคำ
+    def __init__(self, config):
+        self.root = {}
+        self.entries = 0
+        self.symptom_labels = {}
+        self.device_types = tuple(config["device_types"])
+        for device_type, aliases in config["device_types"].items():
+            for alias in aliases:
+                self._add(alias, ("type", device_type, None, device_type))
+        for brand, spec in config["brands"].items():
+            for alias in spec["aliases"]:
+                self._add(alias, ("brand", brand, brand, spec.get("device_type")))
+            for model, model_spec in spec.get("models", {}).items():
+                device_type = model_spec.get("device_type", spec.get("device_type"))
+                for alias in model_spec["aliases"]:
+                    self._add(alias, ("model", model, brand, device_type))
+        for tag, spec in config["symptoms"].items():
+            self.symptom_labels[tag] = spec["label"]
+            for alias in spec["aliases"]:
+                self._add(alias, ("symptom", tag, None, None))
+
+    def _add(self, alias, hit):
+        node = self.root
+        for char in _normalize_repair_text(alias):
+            node = node.setdefault(char, {})
+        if node.get(_TRIE_END, hit) != hit:
+            raise ValueError(f"repair catalog: '{alias}' ใช้ซ้ำกับ {node[_TRIE_END][1]} และ {hit[1]}")
+        node[_TRIE_END] = hit
+        self.entries += 1
+
+    def scan(self, text):
+        hits = []
+        root = self.root
+        i, n = 0, len(text)
+        while i < n:
+            # ชื่อภาษาอังกฤษต้องไม่อยู่กลางคำ เช่น "hp" ใน "chp"
+            if i and _is_ascii_word(text[i]) and _is_ascii_word(text[i - 1]):
+                i += 1
+                continue
+            node, end, hit = root, i, None
+            j = i
+            while j < n:
+                node = node.get(text[j])
+                if node is None:
+                    break
+                j += 1
+                if _TRIE_END in node and (j == n or not (_is_ascii_word(text[j - 1]) and _is_ascii_word(text[j]))):
+                    end, hit = j, node[_TRIE_END]
+            if hit:
+                hits.append(hit)
+                i = end
+            else:
+                i += 1
+        return hits
+
+    def parse(self, text):
+        details = {}
+        tags = []
+        implied_type = None
+        for kind, name, brand, device_type in self.scan(_normalize_repair_text(text)):
+            if kind == "symptom":
+                if name not in tags:
+                    tags.append(name)
+            elif kind == "type":
+                details.setdefault("type", name)
+            elif details.setdefault("brand", brand) == brand:
+                # รุ่นของยี่ห้ออื่นที่ไม่ตรงกับยี่ห้อที่พิมพ์มา ไม่นับ
+                if kind == "model":
+                    details.setdefault("model", name)
+                implied_type = implied_type or device_type
+        if implied_type:
+            details.setdefault("type", implied_type)
+        labels = parse_repair_labels(text)
+        for field in ("brand", "model"):
+            if field not in details and labels.get(field):
+                details[field] = labels[field]
+        symptom = labels.get("symptom") or ", ".join(self.symptom_labels[tag] for tag in tags)
+        if symptom:
+            details["symptom"] = symptom
+        if tags:
+            details["tags"] = tags
+        return details
+
+    def stats(self):
+        return {"entries": self.entries, "symptom_tags": len(self.symptom_labels)}
+
+def missing_repair_fields(data):
+    return tuple(field for field in REPAIR_REQUIRED_FIELDS if not data.get(field))
+
+def repair_columns(data):
+    # คอลัมน์ device_type/brand/model/symptom_tags ของ tickets ประเภทที่พิมพ์เองนอกปุ่มด่วนนับเป็นอุปกรณ์อื่น
+    device_type = data.get("type")
+    if device_type and device_type not in repair_catalog.device_types:
+        device_type = REPAIR_OTHER_TYPE
+    return (device_type, data.get("brand"), data.get("model"), data.get("tags", []))
+
+def structure_repair(data):
+    # ticket เก่าที่เก็บแค่ type + detail แบบข้อความ อ่านซ้ำด้วย catalog ปัจจุบัน
+    details = repair_catalog.parse(f"{data.get('type', '')}\n{data.get('detail', '')}")
+    for field in ("brand", "model"):
+        if data.get(field):
+            details[field] = data[field]
+    if data.get("type") in repair_catalog.device_types:
+        details["type"] = data["type"]
+    elif data.get("type") and "type" not in details:
+        details["type"] = REPAIR_OTHER_TYPE
+    details["tags"] = details.get("tags", []) + [tag for tag in data.get("tags", []) if tag not in details.get("tags", [])]
+    return details
+
+class RepairTurns:
+    # จำนวนข้อความที่ลูกค้าส่งต่อหนึ่งใบแจ้งซ่อม (ต่อ process)
+    # flow เดิมใช้ 4 ข้อความเสมอ: แจ้งซ่อม > ประเภท > รายละเอียด > รูป/ข้าม
+    def __init__(self):
+        self.histogram = {}
+        self._lock = threading.Lock()
+
+    def add(self, turns):
+        with self._lock:
+            self.histogram[turns] = self.histogram.get(turns, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            histogram = dict(sorted(self.histogram.items()))
+        tickets = sum(histogram.values())
+        return {
+            "tickets": tickets,
+            "avg_turns": round(sum(turns * count for turns, count in histogram.items()) / tickets, 2) if tickets else None,
+            "turns": histogram,
+        }
+
+def load_repair_catalog(path):
+    with open(path, encoding="utf-8") as f:
+        return RepairCatalog(json.load(f))
+
+repair_catalog = load_repair_catalog(REPAIR_CATALOG)
+repair_turns = RepairTurns()
+
+class RepairCostEstimates:
+    # ช่วงราคา p25-p75 ต่อ (ประเภท, ยี่ห้อ, อาการ) โหลดทั้งตาราง repair_cost_estimates เข้า dict
+    # แล้วโหลดใหม่ทุก refresh_interval ตอนตอบลูกค้าเป็นแค่การค้น dict ไม่แตะ DB
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.hits = 0
+        self.misses = 0
+        self.loaded_at = None
+        self._table = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._refresh_loop, name="repair-estimates", daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.load()
+            except psycopg2.Error as e:
+                print(f"Error loading repair cost estimates: {e}")
+            time.sleep(self.refresh_interval)
+
+    def load(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT device_type, brand, symptom_tag, low, high, samples FROM repair_cost_estimates")
+            table = {(device_type, brand, tag): (low, high, samples) for device_type, brand, tag, low, high, samples in cur}
+        self._table = table
+        self.loaded_at = time.time()
+
+    def estimate(self, device_type, brand, tags):
+        # ระบุละเอียดสุดก่อน: ยี่ห้อ+อาการ > อาการอย่างเดียว > ยี่ห้ออย่างเดียว ("" = ทุกยี่ห้อ/ทุกอาการ)
+        self.start()
+        table = self._table
+        brand = brand or ""
+        keys = [(device_type, brand, tag) for tag in tags] + [(device_type, "", tag) for tag in tags]
+        if brand:
+            keys.append((device_type, brand, ""))
+        for key in keys:
+            found = table.get(key)
+            if found is not None:
+                self.hits += 1
+                return found
+        self.misses += 1
+        return None
+
+    def stats(self):
+        return {
+            "keys": len(self._table),
+            "age_s": round(time.time() - self.loaded_at) if self.loaded_at else None,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+repair_estimates = RepairCostEstimates(REPAIR_ESTIMATE_REFRESH) if DATABASE_URL and REPAIR_ESTIMATES else None
+
+def format_estimate(estimate):
+    low, high, samples = estimate
+    price = f"{low:,} บาท" if low == high else f"{low:,}-{high:,} บาท"
+    return f"ประมาณ {price} (จากงานซ่อม {samples:,} งาน)"
 
 # ================= FLEX =================
-def create_closed_sunday_flex():
+def _summary_card_layout(with_hero):
+    bubble = {"type": "bubble"}
+    if with_hero:
+        bubble["hero"] = {
+            "type": "image", "url": Slot("image_url", 1000),
+            "size": "full", "aspectRatio": "4:3", "aspectMode": "cover", "animated": False
+        }
+    bubble["body"] = {
+        "type": "box", "layout": "vertical",
+        "contents": [
+            {"type": "text", "text": Slot("title", 100), "size": "lg", "wrap": True, "weight": "bold"},
+            {"type": "separator", "margin": "md"},
+            RepeatSlot("items", ("label", "value"), {
+                "type": "box", "layout": "baseline", "spacing": "sm", "margin": "md",
+                "contents": [
+                    {"type": "text", "text": Slot("label", 40), "flex": 2, "size": "sm", "color": "#aaaaaa"},
+                    {"type": "text", "text": Slot("value", 400), "flex": 5, "size": "sm", "wrap": True, "color": "#666666"}
+                ]
+            }, max_items=6)
+        ]
+    }
+    bubble["footer"] = {
+        "type": "box", "layout": "vertical", "margin": "lg",
+        "contents": [
+            {"type": "separator"},
+            {"type": "text", "text": Slot("footer_text", 200), "margin": "md", "size": "xs", "align": "center", "color": "#aaaaaa"}
+        ]
+    }
+    return {"type": "flex", "altText": Slot("alt_text", 100), "contents": bubble}
+
+SUMMARY_CARD_TEMPLATE = FlexTemplate(_summary_card_layout(with_hero=True), max_bytes=FLEX_BUBBLE_MAX_BYTES)
+SUMMARY_CARD_TEMPLATE_NO_HERO = FlexTemplate(_summary_card_layout(with_hero=False), max_bytes=FLEX_BUBBLE_MAX_BYTES)
+
+# ขนาด JSON สูงสุดของ carousel ที่ LINE รับได้
+FLEX_CAROUSEL_MAX_BYTES = 50 * 1024
+
+def _job_bubble_layout():
+    def row(label, slot):
+        return {
+            "type": "box", "layout": "baseline", "spacing": "sm", "margin": "md",
+            "contents": [
+                {"type": "text", "text": label, "flex": 2, "size": "sm", "color": "#aaaaaa"},
+                {"type": "text", "text": slot, "flex": 5, "size": "sm", "wrap": True, "color": "#666666"}
+            ]
+        }
+
+    return {
+        "type": "bubble",
+        "body": {
+            "type": "box", "layout": "vertical",
+            "contents": [
+                {"type": "text", "text": "สถานะงานซ่อม", "size": "lg", "wrap": True, "weight": "bold"},
+                {"type": "separator", "margin": "md"},
+                row("เลขที่งาน", Slot("job_code", 40)),
+                row("อุปกรณ์", Slot("device", 100)),
+                row("สถานะ", Slot("status", 100)),
+                row("อัปเดต", Slot("updated", 40))
+            ]
+        }
+    }
+
+JOB_CARD_TEMPLATE = FlexTemplate(
+    {"type": "flex", "altText": Slot("alt_text", 100), "contents": _job_bubble_layout()},
+    max_bytes=FLEX_BUBBLE_MAX_BYTES
+)
+JOB_CAROUSEL_TEMPLATE = FlexTemplate(
+    {"type": "flex", "altText": Slot("alt_text", 100), "contents": {
+        "type": "carousel",
+        "contents": [RepeatSlot("jobs", ("job_code", "device", "status", "updated"), _job_bubble_layout(), max_items=JOB_LOOKUP_LIMIT)]
+    }},
+    max_bytes=FLEX_CAROUSEL_MAX_BYTES
+)
+
+def create_closed_day_flex(reason, next_opening):
+    contents = [
+        TextComponent(text=f"วันนี้ ({reason}) ร้าน Datacom Service ปิดทำการครับ", wrap=True, size='md'),
+        TextComponent(text=f"⏰ เปิดทำการปกติ: {business_schedule.weekly_text()}", wrap=True, size='sm', color='#666666'),
+    ]
+    if next_opening:
+        contents.append(TextComponent(text=f"🔓 เปิดอีกครั้ง: {format_thai_datetime(next_opening)}", wrap=True, size='sm', color='#666666'))
+    contents.append(TextComponent(text="คุณลูกค้าสามารถใช้งานเมนู 'ช่วยเหลือ' ด้านล่างได้ปกตินะครับ หรือฝากข้อความไว้ แอดมินจะรีบดูแลให้ในวันเปิดทำการถัดไปครับ 🙏", wrap=True, size='sm', color='#666666'))
     bubble = BubbleContainer(
         body=BoxComponent(
             layout='vertical',
@@ -38,54 +2347,48 @@ def create_closed_sunday_flex():
             contents=[
                 TextComponent(text="ร้านปิดให้บริการ 🛑", weight='bold', size='xl', color='#e53935'),
                 SeparatorComponent(margin='md'),
-                BoxComponent(
-                    layout='vertical', margin='md', spacing='sm',
-                    contents=[
-                        TextComponent(text="วันนี้ (วันอาทิตย์) ร้าน Datacom Service ปิดทำการครับ", wrap=True, size='md'),
-                        TextComponent(text="⏰ เปิดทำการปกติ: จันทร์ - เสาร์ (08:30 - 18:30 น.)", wrap=True, size='sm', color='#666666'),
-                        TextComponent(text="คุณลูกค้าสามารถใช้งานเมนู 'ช่วยเหลือ' ด้านล่างได้ปกตินะครับ หรือฝากข้อความไว้ แอดมินจะรีบดูแลให้ในวันพรุ่งนี้ครับ 🙏", wrap=True, size='sm', color='#666666')
-                    ]
-                )
+                BoxComponent(layout='vertical', margin='md', spacing='sm', contents=contents)
             ]
         )
     )
-    return FlexSendMessage(alt_text="ร้านปิดทำการวันอาทิตย์", contents=bubble)
+    return FlexSendMessage(alt_text=f"ร้านปิดทำการ{reason}", contents=bubble)
 
 def create_summary_flex(title, color, items, footer_text, image_url=None):
-    body_contents = [
-        TextComponent(text=title, weight='bold', size='lg', wrap=True),
-        SeparatorComponent(margin='md')
-    ]
+    template = SUMMARY_CARD_TEMPLATE if image_url else SUMMARY_CARD_TEMPLATE_NO_HERO
+    return PreparedReply.from_encoded(template.render({
+        "alt_text": title,
+        "title": title,
+        "items": items,
+        "footer_text": footer_text,
+        "image_url": image_url,
+    }))
 
-    for label, value in items:
-        body_contents.append(
-            BoxComponent(
-                layout='baseline',
-                spacing='sm',
-                margin='md',
-                contents=[
-                    TextComponent(text=label, color='#aaaaaa', size='sm', flex=2),
-                    TextComponent(text=value, wrap=True, color='#666666', size='sm', flex=5)
-                ]
-            )
-        )
-
-    footer = BoxComponent(
-        layout='vertical',
-        margin='lg',
-        contents=[
-            SeparatorComponent(),
-            TextComponent(text=footer_text, color='#aaaaaa', size='xs', align='center', margin='md')
-        ]
-    )
+def create_ready_message(jobs):
+    lines = ["✅ งานซ่อมของคุณลูกค้าพร้อมแล้วครับ"]
+    for job_code, device, status in jobs:
+        label = f"{job_code} {device}" if device else job_code
+        lines.append(f"• {label}: {status}")
+    lines.append(f"รับเครื่องได้ที่ร้าน {business_schedule.weekly_text()} ครับ 🙏")
+    return PreparedReply(TextSendMessage(text="\n".join(lines)))
 
-    bubble = BubbleContainer(
-        hero=ImageComponent(url=image_url, size='full', aspect_ratio='4:3', aspect_mode='cover') if image_url else None,
-        body=BoxComponent(layout='vertical', paddingAll='lg', contents=body_contents),
-        footer=footer
-    )
+def format_thai_date(moment):
+    return f"{moment.day} {THAI_MONTHS_SHORT[moment.month - 1]} {moment.year + 543} {moment:%H:%M} น."
 
-    return FlexSendMessage(alt_text=title, contents=bubble)
+def create_job_status_flex(jobs):
+    rows = [
+        (job.job_code, job.device or "-", job.status, format_thai_date(job.updated_at.astimezone(business_schedule.tz)))
+        for job in jobs
+    ]
+    if len(rows) == 1:
+        job_code, device, status, updated = rows[0]
+        return PreparedReply.from_encoded(JOB_CARD_TEMPLATE.render({
+            "alt_text": f"สถานะงานซ่อม {job_code}: {status}",
+            "job_code": job_code, "device": device, "status": status, "updated": updated,
+        }))
+    return PreparedReply.from_encoded(JOB_CAROUSEL_TEMPLATE.render({
+        "alt_text": f"สถานะงานซ่อม {len(rows)} รายการ",
+        "jobs": rows,
+    }))
 
 def create_location_card():
     return FlexSendMessage(
@@ -104,7 +2407,7 @@ def create_location_card():
                         layout='vertical', margin='md',
                         contents=[
                             TextComponent(text="📍 123 ถ.สุขุมวิท กรุงเทพฯ", wrap=True),
-                            TextComponent(text="⏰ 09:00 - 18:30 น. (จ-ส)", wrap=True)
+                            TextComponent(text=f"⏰ {business_schedule.weekly_text(short=True)}", wrap=True)
                         ]
                     )
                 ]
@@ -125,272 +2428,863 @@ def skip_image_qr():
         QuickReplyButton(action=MessageAction(label="❌ ยกเลิก", text="ยกเลิก"))
     ])
 
+def confirm_repair_qr():
+    return QuickReply(items=[
+        QuickReplyButton(action=MessageAction(label="✅ ยืนยันแจ้งซ่อม", text="ยืนยันแจ้งซ่อม")),
+        QuickReplyButton(action=MessageAction(label="❌ ไม่ใช่", text="ยกเลิก"))
+    ])
+
 def cancel_qr():
     return QuickReply(items=[
         QuickReplyButton(action=MessageAction(label="❌ ยกเลิก", text="ยกเลิก"))
     ])
 
 # ================= IMAGEMAP =================
-def create_help_imagemap():
-    base_url = "https://datacom-chatbot.onrender.com/imagemap/help" 
-    
-    return ImagemapSendMessage(
-        base_url=base_url,
-        alt_text="เมนูช่วยเหลือ",
-        base_size=BaseSize(height=520, width=1040),
-        actions=[
-            URIImagemapAction(
-                link_uri='https://maps.app.goo.gl/i6819NkupemvipH9A',
-                area=ImagemapArea(x=27, y=30, width=484, height=166)
-            ),
-            MessageImagemapAction(
-                text='เวลาเปิดปิด',
-                area=ImagemapArea(x=534, y=31, width=479, height=163)
-            ),
-            URIImagemapAction(
-                link_uri='https://datacom-service.com/',
-                area=ImagemapArea(x=26, y=221, width=487, height=170)
-            ),
-            MessageImagemapAction(
-                text='ติดต่อด่วนโทร',
-                area=ImagemapArea(x=535, y=221, width=476, height=169)
-            ),
-            MessageImagemapAction(
-                text='คำถามอื่นๆ',
-                area=ImagemapArea(x=29, y=412, width=985, height=87)
-            )
-        ]
-    )
+def encode_rendition(img, size):
+    height = int(img.height * size / img.width)
+    resized = img if size == img.width else img.resize((size, height), Image.Resampling.LANCZOS)
+    img_io = io.BytesIO()
+    resized.save(img_io, "PNG", optimize=True)
+    data = img_io.getvalue()
+    return data, hashlib.sha256(data).hexdigest()[:32]
+
+class ImagemapRenditions:
+    def __init__(self, path, sizes=IMAGEMAP_SIZES):
+        self.path = path
+        self.sizes = sizes
+        self.renders = 0
+        self.render_time = 0.0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _render(self, size):
+        started = time.perf_counter()
+        with Image.open(self.path) as img:
+            rendition = encode_rendition(img, size)
+        self.renders += 1
+        self.render_time += time.perf_counter() - started
+        return rendition
+
+    def get(self, size):
+        rendition = self._cache.get(size)
+        if rendition is None:
+            with self._lock:
+                rendition = self._cache.get(size)
+                if rendition is None:
+                    rendition = self._cache[size] = self._render(size)
+        return rendition
+
+    def warm(self):
+        for size in self.sizes:
+            self.get(size)
+
+    def stats(self):
+        return {
+            "cached": sorted(self._cache),
+            "bytes": sum(len(data) for data, _ in self._cache.values()),
+            "renders": self.renders,
+            "render_ms_total": round(self.render_time * 1000, 3),
+        }
+
+IMAGEMAP_ACTIONS = {
+    "uri": lambda action, area: URIImagemapAction(link_uri=action["uri"], area=area),
+    "message": lambda action, area: MessageImagemapAction(text=action["text"], area=area),
+}
+
+def _imagemap_area(name, area, base_size):
+    x, y, width, height = (int(area[key]) for key in ("x", "y", "width", "height"))
+    if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > base_size.width or y + height > base_size.height:
+        raise ValueError(f"imagemap '{name}': area {area} อยู่นอก BaseSize {base_size.width}x{base_size.height}")
+    return ImagemapArea(x=x, y=y, width=width, height=height)
+
+class Imagemap:
+    def __init__(self, name, spec, public_base_url):
+        path = os.path.join(BASE_DIR, spec["image"])
+        base_size = BaseSize(width=int(spec["base_size"]["width"]), height=int(spec["base_size"]["height"]))
+        if base_size.width != 1040:
+            raise ValueError(f"imagemap '{name}': BaseSize width ต้องเป็น 1040")
+        with Image.open(path) as img:
+            # ความสูงของรูปที่ย่อเป็น 1040 ต้องตรงกับ BaseSize ไม่งั้นพื้นที่กดจะเพี้ยน
+            if int(img.height * base_size.width / img.width) != base_size.height:
+                raise ValueError(f"imagemap '{name}': รูป {img.width}x{img.height} ไม่ตรงกับ BaseSize {base_size.width}x{base_size.height}")
+        actions = []
+        for action in spec["actions"]:
+            if action["type"] not in IMAGEMAP_ACTIONS:
+                raise ValueError(f"imagemap '{name}': ไม่รู้จัก action type '{action['type']}'")
+            actions.append(IMAGEMAP_ACTIONS[action["type"]](action, _imagemap_area(name, action["area"], base_size)))
+        with open(path, "rb") as f:
+            # hash ของรูปต้นฉบับอยู่ใน URL เปลี่ยนรูปเมื่อไหร่ client จะโหลดใหม่เอง
+            self.fingerprint = hashlib.sha256(f.read()).hexdigest()[:16]
+        self.name = name
+        self.path = path
+        self.renditions = ImagemapRenditions(path)
+        self.base_url = f"{public_base_url}/imagemap/{name}/{self.fingerprint}"
+        self.message = ImagemapSendMessage(
+            base_url=self.base_url,
+            alt_text=spec["alt_text"],
+            base_size=base_size,
+            actions=actions
+        ).as_json_dict()
+        self.reply = PreparedReply.from_encoded(encode_json(self.message))
+
+    def reply_for(self, base_url):
+        # ข้อความเดียวกันแต่ชี้ไปที่รูปอีกชุด (พื้นที่กดเหมือนเดิม)
+        return PreparedReply.from_encoded(encode_json(dict(self.message, baseUrl=base_url)))
+
+class ImagemapRegistry:
+    def __init__(self, path, public_base_url):
+        with open(path, encoding="utf-8") as f:
+            specs = json.load(f)
+        self.imagemaps = {name: Imagemap(name, spec, public_base_url) for name, spec in specs.items()}
+
+    def get(self, name):
+        return self.imagemaps.get(name)
+
+    def reply(self, name):
+        return self.imagemaps[name].reply
+
+    def warm(self):
+        for imagemap in self.imagemaps.values():
+            imagemap.renditions.warm()
+
+    def stats(self):
+        return {
+            name: dict(fingerprint=imagemap.fingerprint, **imagemap.renditions.stats())
+            for name, imagemap in self.imagemaps.items()
+        }
+
+imagemap_registry = ImagemapRegistry(IMAGEMAP_CONFIG, PUBLIC_BASE_URL)
+if IMAGEMAP_PRERENDER:
+    imagemap_registry.warm()
+
+# ================= HELP BADGES =================
+BADGE_GREEN = (46, 160, 67)
+BADGE_RED = (220, 53, 69)
+BADGE_GREY = (108, 117, 125)
+BADGE_PURPLE = (124, 77, 255)
+
+def _badge_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except (TypeError, OSError):
+        return ImageFont.load_default()
+
+class BadgeVariant:
+    __slots__ = ("key", "renditions", "reply")
+
+    def __init__(self, key, renditions, reply):
+        self.key = key
+        self.renditions = renditions
+        self.reply = reply
+
+class HelpBadgeVariants:
+    # รูป imagemap ช่วยเหลือพร้อม badge สถานะร้าน (เปิด/ปิด, เวลาวันนี้, คิว)
+    # render ใน thread เบื้องหลังเท่านั้น ถ้ายังไม่มีรูปของ state ปัจจุบันให้ส่งรูปปกติไปก่อน
+    def __init__(self, imagemap, state_func, max_variants=32, refresh_interval=60, refresh_func=None):
+        self.imagemap = imagemap
+        self.state_func = state_func
+        # ค่าที่ต้อง query (เช่นจำนวนคิว) อัปเดตใน thread นี้ state_func บนทางตอบอ่านแค่ค่าที่เก็บไว้
+        self.refresh_func = refresh_func
+        self.max_variants = max_variants
+        self.refresh_interval = refresh_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.renders = 0
+        self.render_time = 0.0
+        self._variants = OrderedDict()
+        self._by_key = {}
+        self._lock = threading.Lock()
+        # state ที่รอ render มีได้ไม่กี่แบบ (เปิด/ปิด x คิว) คิวเต็มก็ไม่ต้องใส่ซ้ำ
+        self._pending = queue.Queue(maxsize=max_variants)
+        self._pid = None
+        self._font = _badge_font(22)
+        with Image.open(imagemap.path) as img:
+            self._base = img.convert("RGB")
+
+    def start(self):
+        # เริ่ม thread ครั้งแรกที่ใช้ในแต่ละ process เพราะ worker ถูก fork หลัง import
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pending = queue.Queue(maxsize=self.max_variants)
+                    threading.Thread(target=self._render_loop, name="help-badge-renderer", daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _key(self, state):
+        return hashlib.sha256(f"{self.imagemap.fingerprint}:{state!r}".encode("utf-8")).hexdigest()[:16]
+
+    def _pill(self, draw, anchor_x, y, text, color, align_right=False):
+        left, top, right, bottom = draw.textbbox((0, 0), text, font=self._font)
+        width, height = right - left + 24, bottom - top + 14
+        x = anchor_x - width if align_right else anchor_x
+        draw.rounded_rectangle((x, y, x + width, y + height), radius=height // 2, fill=color)
+        draw.text((x + 12 - left, y + 7 - top), text, font=self._font, fill=(255, 255, 255))
+
+    def _draw(self, state):
+        status, hours, queue_length = state
+        img = self._base.copy()
+        draw = ImageDraw.Draw(img)
+        # การ์ด "เวลาเปิด-ปิด" และ "ติดต่อด่วนโทร" ในรูป 1040x520
+        self._pill(draw, 545, 38, status, BADGE_GREEN if status == "OPEN" else BADGE_RED)
+        self._pill(draw, 1000, 38, hours, BADGE_GREY, align_right=True)
+        self._pill(draw, 1000, 232, f"QUEUE {queue_length}", BADGE_PURPLE, align_right=True)
+        return img
+
+    def _render(self, state):
+        started = time.perf_counter()
+        img = self._draw(state)
+        renditions = {size: encode_rendition(img, size) for size in IMAGEMAP_SIZES}
+        key = self._key(state)
+        variant = BadgeVariant(key, renditions, self.imagemap.reply_for(f"{PUBLIC_BASE_URL}/imagemap/{self.imagemap.name}/v/{key}"))
+        with self._lock:
+            self._variants[state] = variant
+            self._by_key[key] = variant
+            while len(self._variants) > self.max_variants:
+                _, evicted = self._variants.popitem(last=False)
+                del self._by_key[evicted.key]
+                self.evictions += 1
+            self.renders += 1
+            self.render_time += time.perf_counter() - started
+
+    def _render_loop(self):
+        refreshed_at = None
+        while True:
+            if self.refresh_func and (refreshed_at is None or time.monotonic() - refreshed_at >= self.refresh_interval):
+                self.refresh_func()
+                refreshed_at = time.monotonic()
+            try:
+                state = self._pending.get(timeout=self.refresh_interval)
+            except queue.Empty:
+                state = self.state_func()
+            if state in self._variants:
+                continue
+            try:
+                self._render(state)
+            except Exception as e:
+                print(f"Error rendering help badges: {e}")
+
+    def reply(self):
+        self.start()
+        state = self.state_func()
+        with self._lock:
+            variant = self._variants.get(state)
+            if variant is not None:
+                self._variants.move_to_end(state)
+                self.hits += 1
+                return variant.reply
+            self.misses += 1
+        try:
+            self._pending.put_nowait(state)
+        except queue.Full:
+            pass
+        return self.imagemap.reply
+
+    def rendition(self, key, size):
+        variant = self._by_key.get(key)
+        return variant.renditions.get(size) if variant else None
+
+    def stats(self):
+        with self._lock:
+            variants = list(self._variants.values())
+            return {
+                "variants": len(variants),
+                "max_variants": self.max_variants,
+                "bytes": sum(len(data) for v in variants for data, _ in v.renditions.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "renders": self.renders,
+                "render_ms_avg": round(self.render_time * 1000 / self.renders, 3) if self.renders else 0.0,
+            }
+
+class DailyCounter:
+    # นับจำนวนงานที่รับเข้ามาวันนี้ (ต่อ process) ใช้เป็นตัวเลขคิวบน badge
+    def __init__(self):
+        self.day = None
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, now):
+        with self._lock:
+            if now.date() != self.day:
+                self.day, self.count = now.date(), 0
+            self.count += 1
+
+    def value(self, now):
+        return self.count if now.date() == self.day else 0
+
+submission_counter = DailyCounter()
+
+def refresh_badge_counts():
+    if ticket_writer is None:
+        return
+    try:
+        ticket_writer.refresh_open_repairs()
+    except psycopg2.Error as e:
+        print(f"Error counting open repairs: {e}")
+
+def repair_queue_length(now):
+    count = ticket_writer.open_repairs() if ticket_writer else None
+    return submission_counter.value(now) if count is None else count
+
+def help_badge_state():
+    now = business_schedule.now()
+    queue_length = repair_queue_length(now)
+    hours = business_schedule.today_hours(now)
+    if not hours:
+        return ("CLOSED", "CLOSED TODAY", queue_length)
+    hours_text = " ".join(f"{open_at:%H:%M}-{close_at:%H:%M}" for open_at, close_at in hours)
+    return ("OPEN" if business_schedule.is_open(now) else "CLOSED", hours_text, queue_length)
+
+help_badges = None
+if HELP_BADGES:
+    help_badges = HelpBadgeVariants(imagemap_registry.get("help"), help_badge_state, HELP_BADGE_VARIANTS, HELP_BADGE_REFRESH, refresh_badge_counts)
+
+# ================= STATIC REPLIES =================
+# ข้อความที่ไม่เปลี่ยนตามผู้ใช้ สร้างและ serialize ครั้งเดียวตอนเริ่มแอป
+LOCATION_REPLY = PreparedReply(create_location_card())
+HELP_IMAGEMAP_REPLY = imagemap_registry.reply("help")
+
+CANCELLED_REPLY = PreparedReply(TextSendMessage(text="❌ ยกเลิกรายการเรียบร้อยแล้วครับ หากต้องการสอบถามเพิ่มเติมเลือกเมนูด้านล่างได้เลยนะครับ"))
+
+CHECK_STATUS_PROMPT_REPLY = PreparedReply(
+    TextSendMessage(text="🔍 สามารถตรวจสอบสถานะได้ง่ายๆ เลยครับ รบกวนพิมพ์ 'เบอร์โทรศัพท์' หรือ 'รหัสงานซ่อม' ส่งมาได้เลยครับ", quick_reply=cancel_qr())
+)
+CHECK_STATUS_INVALID_REPLY = PreparedReply(
+    TextSendMessage(text="⚠️ รูปแบบไม่ถูกต้องครับ รบกวนพิมพ์ 'เบอร์โทรศัพท์' (เช่น 0812345678) หรือ 'รหัสงานซ่อม' อีกครั้งนะครับ", quick_reply=cancel_qr())
+)
+
+REPAIR_TYPE_PROMPT_REPLY = PreparedReply(TextSendMessage(
+    text="🛠️ คุณลูกค้าต้องการแจ้งซ่อมอุปกรณ์ประเภทไหนครับ?",
+    quick_reply=QuickReply(items=[
+        QuickReplyButton(action=MessageAction(label="💻 คอมพิวเตอร์", text="คอมพิวเตอร์")),
+        QuickReplyButton(action=MessageAction(label="🖨️ ปริ้นเตอร์", text="ปริ้นเตอร์")),
+        QuickReplyButton(action=MessageAction(label="⌨️ อื่นๆ", text="อุปกรณ์อื่น")),
+        QuickReplyButton(action=MessageAction(label="❌ ยกเลิก", text="ยกเลิก"))
+    ])
+))
+
+REPAIR_DETAIL_PROMPT_REPLY = PreparedReply(TextSendMessage(
+    text=(
+        "📝 รบกวนแจ้งรายละเอียดตามนี้ เพื่อให้ช่างประเมินได้แม่นยำขึ้นนะครับ\n"
+        "- ยี่ห้อ:\n"
+        "- รุ่น:\n"
+        "- อาการที่พบ:\n"
+        "(สามารถพิมพ์รวมกันแล้วส่งมาในข้อความเดียวได้เลยครับ)"
+    ),
+    quick_reply=cancel_qr()
+))
+
+REPAIR_IMAGE_PROMPT_REPLY = PreparedReply(
+    TextSendMessage(text="📸 หากมีรูปภาพอุปกรณ์หรืออาการเสีย สามารถส่งมาให้ดูได้เลยนะครับ\n(ถ้าไม่มี สามารถกด 'ข้าม' ที่เมนูด้านล่างได้เลยครับ)", quick_reply=skip_image_qr())
+)
+
+ORG_DETAIL_PROMPT_REPLY = PreparedReply(TextSendMessage(
+    text=(
+        "🏢 สำหรับลูกค้าองค์กร/หน่วยงาน รบกวนแจ้งรายละเอียดเบื้องต้นตามนี้นะครับ\n\n"
+        "- ชื่อหน่วยงาน:\n"
+        "- รายการสินค้าและจำนวนที่ต้องการ:\n\n"
+        "(หลังจากได้รับข้อมูล แอดมินจะรีบตรวจสอบและจัดทำใบเสนอราคาให้ครับ)"
+    ),
+    quick_reply=cancel_qr()
+))
+
+ORG_IMAGE_PROMPT_REPLY = PreparedReply(
+    TextSendMessage(text="📸 หากมีรูปภาพตัวอย่างสินค้า สามารถส่งมาได้เลยนะครับ\n(ถ้าไม่มี สามารถกด 'ข้าม' ที่เมนูด้านล่างได้เลยครับ)", quick_reply=skip_image_qr())
+)
+
+INQUIRY_PRODUCT_PROMPT_REPLY = PreparedReply(
+    TextSendMessage(text="📦 สนใจสอบถามสินค้าตัวไหน หรือกำลังตามหาอุปกรณ์ชิ้นไหนอยู่ แจ้งแอดมินได้เลยครับ", quick_reply=cancel_qr())
+)
+
+INQUIRY_IMAGE_PROMPT_REPLY = PreparedReply(
+    TextSendMessage(text="📸 มีรูปภาพสินค้าตัวอย่างไหมครับ?\n(ถ้าไม่มี สามารถกด 'ข้าม' ที่เมนูด้านล่างได้เลยครับ)", quick_reply=skip_image_qr())
+)
+
+HOURS_REPLY = PreparedReply(TextSendMessage(text=f"⏰ ร้านเปิดให้บริการ {business_schedule.weekly_text()} (หยุด{business_schedule.weekly_closed_text()}) ยินดีต้อนรับเสมอนะครับ"))
+HOTLINE_REPLY = PreparedReply(TextSendMessage(text="📞 โทรติดต่อด่วน: 098-794-6235, 06-1994-1928\n📞 โทรติดต่อเบอร์ร้าน: 056-223-547"))
+OTHER_QUESTIONS_REPLY = PreparedReply(TextSendMessage(text="💬 คุณลูกค้าสามารถพิมพ์คำถามหรือข้อสงสัยทิ้งไว้ได้เลยนะครับ แอดมินจะรีบเข้ามาตอบกลับให้เร็วที่สุดครับ ขอบคุณครับ 🙏"))
+
+GREETING_REPLY = PreparedReply(TextSendMessage(
+    text="👋 สวัสดีครับ Datacom Service ยินดีให้บริการครับ 😊\nคุณลูกค้าต้องการให้เราดูแลเรื่องไหน สามารถเลือกเมนูด้านล่างได้เลยนะครับ 👇",
+    quick_reply=QuickReply(items=[
+        QuickReplyButton(action=MessageAction(label="🔧 แจ้งซ่อม", text="แจ้งซ่อม")),
+        QuickReplyButton(action=MessageAction(label="🏢 สั่งซื้อหน่วยงาน", text="สั่งซื้อหน่วยงาน")),
+        QuickReplyButton(action=MessageAction(label="📦 สอบถามสินค้า", text="สอบถามสินค้า")),
+        QuickReplyButton(action=MessageAction(label="ℹ️ ช่วยเหลือ", text="ช่วยเหลือ")),
+        QuickReplyButton(action=MessageAction(label="📍 ติดต่อเรา", text="ติดต่อเรา"))
+    ])
+))
+
+@lru_cache(maxsize=16)
+def repair_missing_reply(fields):
+    # ถามเฉพาะช่องที่ยังขาด แทนการขอรายละเอียดทั้งหมดใหม่
+    lines = "\n".join(f"- {REPAIR_FIELD_LABELS[field]}:" for field in fields)
+    return PreparedReply(TextSendMessage(
+        text=f"📝 ขอข้อมูลเพิ่มอีกนิดนะครับ\n{lines}\n(พิมพ์ส่งมาในข้อความเดียวได้เลยครับ)",
+        quick_reply=cancel_qr()
+    ))
+
+def repair_confirm_reply(data):
+    # ข้อความทั่วไปที่บังเอิญมีครบ ประเภท ยี่ห้อ อาการ (ถามราคา ถามซื้อหมึก) ต้องให้ลูกค้ายืนยันก่อนเปิด ticket
+    device = " ".join(data[field] for field in ("type", "brand", "model") if data.get(field))
+    return PreparedReply(TextSendMessage(
+        text=f"🛠️ ต้องการแจ้งซ่อม {device}\nอาการ: {data['symptom']}\nใช่ไหมครับ?\n(ส่งรูปอาการเสียมาได้เลย หรือกด 'ยืนยันแจ้งซ่อม')",
+        quick_reply=confirm_repair_qr()
+    ))
+
+@lru_cache(maxsize=64)
+def closed_day_reply(reason, next_opening):
+    # การ์ดร้านปิดเปลี่ยนแค่ตามวัน จึง cache ตามเหตุผลและเวลาเปิดครั้งถัดไป
+    return PreparedReply(create_closed_day_flex(reason, next_opening))
 
 # ================= IMAGEMAP ROUTE =================
-@app.route("/imagemap/help/<int:size>", methods=["GET"])
-def serve_imagemap(size):
-    if size not in [1040, 700, 460, 300, 240]:
+def send_png(data, etag, cache_control="public, max-age=31536000, immutable"):
+    response = app.response_class(data, mimetype="image/png")
+    response.set_etag(etag)
+    # ไฟล์ของแต่ละ URL ไม่เปลี่ยนแล้ว ให้ LINE client cache ได้ตลอด
+    response.headers["Cache-Control"] = cache_control
+    return response.make_conditional(request)
+
+def serve_rendition(imagemap, size, cache_control=None):
+    if imagemap is None or size not in IMAGEMAP_SIZES:
         abort(404)
-        
-    original_image_path = os.path.join("static", "help_menu.png")
-    
     try:
-        img = Image.open(original_image_path)
-        
-        width_percent = (size / float(img.size[0]))
-        new_height = int((float(img.size[1]) * float(width_percent)))
-        
-        img_resized = img.resize((size, new_height), Image.Resampling.LANCZOS)
-        
-        img_io = io.BytesIO()
-        img_resized.save(img_io, 'PNG', quality=85)
-        img_io.seek(0)
-        
-        return send_file(img_io, mimetype='image/png')
-        
-    except Exception as e:
+        data, etag = imagemap.renditions.get(size)
+    except OSError as e:
         print(f"Error processing imagemap: {e}")
         abort(404)
+    if cache_control:
+        return send_png(data, etag, cache_control)
+    return send_png(data, etag)
+
+@app.route("/imagemap/<name>/<fingerprint>/<int:size>", methods=["GET"])
+def serve_imagemap(name, fingerprint, size):
+    imagemap = imagemap_registry.get(name)
+    if imagemap is not None and imagemap.fingerprint != fingerprint:
+        # imagemap ในแชทเก่ายังชี้ hash เดิม ส่งรูปปัจจุบันแทนแต่ไม่ให้ cache นาน
+        return serve_rendition(imagemap, size, cache_control="public, max-age=60")
+    return serve_rendition(imagemap, size)
+
+@app.route("/imagemap/<name>/v/<key>/<int:size>", methods=["GET"])
+def serve_badge_imagemap(name, key, size):
+    if help_badges is None or name != help_badges.imagemap.name or size not in IMAGEMAP_SIZES:
+        abort(404)
+    rendition = help_badges.rendition(key, size)
+    if rendition is None:
+        # variant ถูกเอาออกจาก cache แล้ว ส่งรูปปกติแทนแต่ไม่ให้ cache นาน
+        return send_png(*help_badges.imagemap.renditions.get(size), cache_control="public, max-age=60")
+    return send_png(*rendition)
+
+# URL เดิมที่ไม่มี hash ยังอยู่ในแชทเก่าของลูกค้า รูปเปลี่ยนได้เมื่อแก้เมนู ห้าม immutable ให้ revalidate ด้วย ETag
+@app.route("/imagemap/help/<int:size>", methods=["GET"])
+def serve_legacy_imagemap(size):
+    return serve_rendition(imagemap_registry.get("help"), size, cache_control="public, max-age=300")
+
+# ================= ROUTER =================
+def normalize_command(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+class CommandRouter:
+    ANY = "*"
+
+    def __init__(self):
+        self._commands = {}
+        self._states = {}
+        self._table = []
+
+    def _register(self, index, key, func, state, trigger, next_state):
+        if key in index:
+            raise ValueError(f"Route {key} is already handled by {index[key][0].__name__}")
+        index[key] = (func, next_state)
+        self._table.append((state, trigger, func.__name__, next_state))
+
+    def command(self, *texts, state="IDLE", next_state=None):
+        # คำสั่งแบบข้อความตรงตัว ใช้ state="*" ถ้าให้ทำงานได้ทุก state
+        def decorator(func):
+            for text in texts:
+                self._register(self._commands, (state, normalize_command(text)), func, state, f"'{text}'", next_state)
+            return func
+        return decorator
+
+    def state(self, state, kind=ANY, next_state=None):
+        # ตัวจัดการ input ใดๆ ใน state นั้น แยกตามชนิด "text" / "image" ได้
+        def decorator(func):
+            self._register(self._states, (state, kind), func, state, f"<{kind}>", next_state)
+            return func
+        return decorator
+
+    def reply(self, *texts, reply, state="IDLE"):
+        def send_static(event, text, session, is_image):
+            send_reply(event.reply_token, reply)
+        send_static.__name__ = f"reply:{normalize_command(texts[0])}"
+        self.command(*texts, state=state)(send_static)
+
+    def resolve(self, state, text, is_image):
+        kind = "image" if is_image else "text"
+        if not is_image:
+            command = normalize_command(text)
+            route = self._commands.get((state, command)) or self._commands.get((self.ANY, command))
+            if route:
+                return route
+        return self._states.get((state, kind)) or self._states.get((state, self.ANY))
+
+    def dispatch(self, event, text, session, is_image):
+        route = self.resolve(session.state, text, is_image)
+        if route is None:
+            print(f"No route for state={session.state} input={'image' if is_image else text!r}")
+            return False
+        func, next_state = route
+        # handler คืนค่า state เองได้ ถ้าไม่คืนจะใช้ next_state ที่ประกาศไว้ตอนลงทะเบียน
+        result = func(event, text, session, is_image)
+        next_state = result or next_state
+        if next_state is not None:
+            session.state = next_state
+        return True
+
+    def has_command(self, state, text):
+        return (state, normalize_command(text)) in self._commands
+
+    def known_states(self):
+        return {row[0] for row in self._table if row[0] != self.ANY} | {row[3] for row in self._table if row[3]}
+
+    def transition_table(self):
+        return sorted(self._table, key=lambda row: (row[0] != "IDLE", row[0], row[1]))
+
+router = CommandRouter()
 
 # ================= WEBHOOK =================
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature")
-    body = request.get_data(as_text=True)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    body = request.get_data()
+    if not verify_signature(body, signature):
         abort(403)
+    events = decode_webhook(body)
+    if LINE_HTTP_WARM:
+        # เปิด connection ไป LINE ระหว่างประมวลผล event แรก reply ถัดๆ ไปไม่ต้องรอ TLS handshake
+        line_bot_api.http_client.warm_once(line_bot_api.endpoint + "/v2/bot/info", LINE_HTTP_WARM)
+    if status_cache:
+        # listener ของ job_changes ต้องรันในทุก worker แม้ยังไม่มีใครตรวจสถานะ
+        status_cache.start()
+    if WEBHOOK_ASYNC:
+        # ตรวจ signature แล้วโยน event เข้าคิวทันที ไม่รอ reply_message
+        for event in events:
+            user_id = event.source.user_id or ""
+            if not webhook_executor.submit(user_id, dispatch_event, event):
+                print(f"Webhook lane full, dropped event from {user_id}")
+        return "OK"
+    for event in events:
+        dispatch_event(event)
     return "OK"
 
-@handler.add(MessageEvent, message=(TextMessage, ImageMessage))
+def dispatch_event(event):
+    if event.type == "message" and event.message.type in ("text", "image"):
+        handle_message(event)
+
+# กลุ่มคำสั่งที่ยอมให้ทำงานได้ในวันที่ร้านปิด
+ALLOWED_WHEN_CLOSED = frozenset([
+    "ช่วยเหลือ", "เวลาเปิดปิด", "ติดต่อด่วนโทร", "คำถามอื่นๆ", "แผนที่", "ติดต่อเรา", "ยกเลิก"
+])
+
+@skip_redelivered
 def handle_message(event):
     user_id = event.source.user_id
-    state = sessions.get(user_id, "IDLE")
+    session = session_store.load(user_id)
 
-    is_image = isinstance(event.message, ImageMessage)
+    is_image = event.message.type == "image"
     text = "__IMAGE__" if is_image else event.message.text.strip()
 
-    # --- เช็ควันอาทิตย์ ---
-    tz = pytz.timezone('Asia/Bangkok')
-    now = datetime.now(tz)
-    is_sunday = now.weekday() == 6  # 0=วันจันทร์, 6=วันอาทิตย์
-
-    # กำหนดกลุ่มคำสั่งที่ยอมให้ทำงานได้ในวันอาทิตย์
-    allowed_on_sunday = [
-        "ช่วยเหลือ", "เวลาเปิดปิด", "ติดต่อด่วนโทร", "คำถามอื่นๆ", "แผนที่", "ติดต่อเรา", "ยกเลิก"
-    ]
+    # --- เช็ควันที่ร้านปิด (วันอาทิตย์ วันหยุด วันปิดพิเศษ) ---
+    now = business_schedule.now()
+    closed_reason = business_schedule.closed_reason(now.date())
 
-    # ถ้าเป็นวันอาทิตย์ และไม่ได้กดเมนูที่อนุญาตไว้
-    if is_sunday and text not in allowed_on_sunday:
+    # ถ้าร้านปิด และไม่ได้กดเมนูที่อนุญาตไว้
+    if closed_reason and text not in ALLOWED_WHEN_CLOSED:
         # เคลียร์สถานะการทำรายการ
-        sessions.pop(user_id, None)
-        user_data.pop(user_id, None)
+        if session.stored:
+            session_store.delete(user_id)
         # ส่งการ์ดแจ้งร้านปิด
-        line_bot_api.reply_message(event.reply_token, create_closed_sunday_flex())
+        send_reply(event.reply_token, closed_day_reply(closed_reason, business_schedule.next_opening(now)))
         return
     # ----------------------------------------
 
-    if text == "ยกเลิก":
-        sessions[user_id] = "IDLE"
-        user_data.pop(user_id, None)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ ยกเลิกรายการเรียบร้อยแล้วครับ หากต้องการสอบถามเพิ่มเติมเลือกเมนูด้านล่างได้เลยนะครับ"))
-        return
-
-    if state == "IDLE":
-        handle_idle(event, text, user_id)
-    elif state == "CHECK_STATUS":
-        handle_check_status(event, text, user_id)
-    elif state.startswith("REPAIR_"):
-        handle_repair(event, text, user_id, state, is_image)
-    elif state.startswith("ORG_"):
-        handle_org(event, text, user_id, state, is_image)
-    elif state.startswith("INQUIRY_"):
-        handle_inquiry(event, text, user_id, state, is_image)
+    router.dispatch(event, text, session, is_image)
+    session_store.save(session)
 
 # ================= FLOWS =================
-def handle_idle(event, text, user_id):
-    if text in ["ติดต่อเรา", "แผนที่"]:
-        line_bot_api.reply_message(event.reply_token, create_location_card())
-        
-    elif text == "ช่วยเหลือ":
-        line_bot_api.reply_message(event.reply_token, create_help_imagemap())
-
-    elif text == "ตรวจสอบสถานะงานซ่อม":
-        sessions[user_id] = "CHECK_STATUS"
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="🔍 สามารถตรวจสอบสถานะได้ง่ายๆ เลยครับ รบกวนพิมพ์ 'เบอร์โทรศัพท์' หรือ 'รหัสงานซ่อม' ส่งมาได้เลยครับ", quick_reply=cancel_qr())
-        )
+@router.command("ยกเลิก", state=CommandRouter.ANY, next_state="IDLE")
+def handle_cancel(event, text, session, is_image):
+    session.data = {}
+    send_reply(event.reply_token, CANCELLED_REPLY)
 
-    elif text == "แจ้งซ่อม":
-        sessions[user_id] = "REPAIR_TYPE"
-        qr = QuickReply(items=[
-            QuickReplyButton(action=MessageAction(label="💻 คอมพิวเตอร์", text="คอมพิวเตอร์")),
-            QuickReplyButton(action=MessageAction(label="🖨️ ปริ้นเตอร์", text="ปริ้นเตอร์")),
-            QuickReplyButton(action=MessageAction(label="⌨️ อื่นๆ", text="อุปกรณ์อื่น")),
-            QuickReplyButton(action=MessageAction(label="❌ ยกเลิก", text="ยกเลิก"))
-        ])
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="🛠️ คุณลูกค้าต้องการแจ้งซ่อมอุปกรณ์ประเภทไหนครับ?", quick_reply=qr))
-
-    elif text == "สั่งซื้อหน่วยงาน":
-        sessions[user_id] = "ORG_DETAIL"
-        prompt_text = (
-            "🏢 สำหรับลูกค้าองค์กร/หน่วยงาน รบกวนแจ้งรายละเอียดเบื้องต้นตามนี้นะครับ\n\n"
-            "- ชื่อหน่วยงาน:\n"
-            "- รายการสินค้าและจำนวนที่ต้องการ:\n\n"
-            "(หลังจากได้รับข้อมูล แอดมินจะรีบตรวจสอบและจัดทำใบเสนอราคาให้ครับ)"
-        )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=prompt_text, quick_reply=cancel_qr()))
+router.reply("ติดต่อเรา", "แผนที่", reply=LOCATION_REPLY)
+@router.command("ช่วยเหลือ")
+def handle_help(event, text, session, is_image):
+    send_reply(event.reply_token, help_badges.reply() if help_badges else HELP_IMAGEMAP_REPLY)
+
+# --- ดักจับข้อความที่มาจาก Imagemap ---
+router.reply("เวลาเปิดปิด", reply=HOURS_REPLY)
+router.reply("ติดต่อด่วนโทร", reply=HOTLINE_REPLY)
+router.reply("คำถามอื่นๆ", reply=OTHER_QUESTIONS_REPLY)
+
+@router.command("ตรวจสอบสถานะงานซ่อม", next_state="CHECK_STATUS")
+def start_check_status(event, text, session, is_image):
+    send_reply(event.reply_token, CHECK_STATUS_PROMPT_REPLY)
 
-    elif text == "สอบถามสินค้า":
-        sessions[user_id] = "INQUIRY_PRODUCT"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="📦 สนใจสอบถามสินค้าตัวไหน หรือกำลังตามหาอุปกรณ์ชิ้นไหนอยู่ แจ้งแอดมินได้เลยครับ", quick_reply=cancel_qr()))
+@router.command("แจ้งซ่อม", next_state="REPAIR_TYPE")
+def start_repair(event, text, session, is_image):
+    session.data = {"turns": 1}
+    send_reply(event.reply_token, REPAIR_TYPE_PROMPT_REPLY)
+
+@router.command("สั่งซื้อหน่วยงาน", next_state="ORG_DETAIL")
+def start_org(event, text, session, is_image):
+    send_reply(event.reply_token, ORG_DETAIL_PROMPT_REPLY)
+
+@router.command("สอบถามสินค้า", next_state="INQUIRY_PRODUCT")
+def start_inquiry(event, text, session, is_image):
+    send_reply(event.reply_token, INQUIRY_PRODUCT_PROMPT_REPLY)
+
+@router.state("IDLE")
+def handle_idle(event, text, session, is_image):
+    # พิมพ์เบอร์โทรหรือรหัสงานมาเลยโดยไม่ต้องกดเมนูก่อน ตอบสถานะทันที
+    # รุ่นเครื่อง (HP1020, L3110) หน้าตาเหมือนรหัสงาน ตอบเฉพาะเมื่อเจองานจริง ไม่เจอให้ไปทางแจ้งซ่อม/ทักทายตามปกติ
+    kind, value = (None, text) if is_image else classify_lookup(text)
+    if kind is not None and job_index_ready():
+        jobs = lookup_jobs(kind, value)
+        if jobs:
+            reply_jobs(event, jobs)
+            return
+    if not is_image:
+        # แจ้งซ่อมมาครบในข้อความเดียว (ประเภท ยี่ห้อ อาการ) กรอกไว้ให้แล้วถามยืนยันก่อน
+        details = repair_catalog.parse(text)
+        if not missing_repair_fields(details):
+            session.data = dict(details, detail=session_text(text), turns=1)
+            send_reply(event.reply_token, repair_confirm_reply(session.data))
+            return "REPAIR_CONFIRM"
+    send_reply(event.reply_token, GREETING_REPLY)
+
+def dispatch_as_idle(event, text, session, is_image):
+    # ข้อความที่ไม่ใช่คำตอบของ state ปัจจุบัน (เช่นกดเมนู) ทิ้งรายการที่ค้างแล้วจัดการแบบ IDLE
+    session.state, session.data = "IDLE", {}
+    router.dispatch(event, text, session, is_image)
+    return session.state
+
+# ---------- CHECK STATUS ----------
+@router.state("CHECK_STATUS", next_state="IDLE")
+def handle_check_status(event, text, session, is_image):
+    # กดเมนูอื่นระหว่างรอเบอร์/รหัสงาน ทำตามเมนูนั้นเลย
+    if not is_image and router.has_command("IDLE", text):
+        return dispatch_as_idle(event, text, session, is_image)
+    kind, value = normalize_lookup(text)
+    if kind is None:
+        send_reply(event.reply_token, CHECK_STATUS_INVALID_REPLY)
+        # ให้พิมพ์ใหม่ได้อีกครั้งเดียว แล้วกลับ IDLE ตามเดิม
+        if session.data.get("retried"):
+            session.data = {}
+            return "IDLE"
+        session.data = {"retried": True}
+        return "CHECK_STATUS"
+    session.data = {}
+    reply_status(event, kind, value, text)
 
-    # --- ดักจับข้อความที่มาจาก Imagemap ---
-    elif text == "เวลาเปิดปิด":
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⏰ ร้านเปิดให้บริการ จันทร์-เสาร์ เวลา 08:30 - 18:30 น. (หยุดวันอาทิตย์) ยินดีต้อนรับเสมอนะครับ"))
-    elif text == "ติดต่อด่วนโทร":
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="📞 โทรติดต่อด่วน: 098-794-6235, 06-1994-1928\n📞 โทรติดต่อเบอร์ร้าน: 056-223-547"))
-    elif text == "คำถามอื่นๆ":
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="💬 คุณลูกค้าสามารถพิมพ์คำถามหรือข้อสงสัยทิ้งไว้ได้เลยนะครับ แอดมินจะรีบเข้ามาตอบกลับให้เร็วที่สุดครับ ขอบคุณครับ 🙏"))
+def job_index_ready():
+    # ไม่มีตาราง jobs หรือ Bloom filter ยังสร้างไม่เสร็จ ยังไม่เดารหัสงานจากข้อความทั่วไป
+    if status_cache is None:
+        return False
+    status_cache.start()
+    return status_cache.listening and (job_bloom is None or job_bloom.ready)
 
+def lookup_jobs(kind, value):
+    # None = ตรวจไม่ได้ (ไม่มี DB หรือ DB มีปัญหา)
+    if not DATABASE_URL:
+        return None
+    try:
+        return status_cache.lookup(kind, value)
+    except psycopg2.Error as e:
+        print(f"Error looking up jobs: {e}")
+        return None
+
+def reply_jobs(event, jobs):
+    send_reply(event.reply_token, create_job_status_flex(jobs))
+    if status_notifier:
+        try:
+            status_notifier.watch(event.source.user_id, [job.job_code for job in jobs])
+        except psycopg2.Error as e:
+            print(f"Error saving job watchers: {e}")
+
+def reply_status(event, kind, value, text):
+    jobs = lookup_jobs(kind, value)
+    if jobs:
+        reply_jobs(event, jobs)
+    elif jobs is not None:
+        send_reply(event.reply_token, TextSendMessage(text=f"🔍 ไม่พบงานซ่อมของ: {value}\n(แอดมินจะตรวจสอบและแจ้งกลับให้อีกครั้งนะครับ)"))
     else:
-        qr = QuickReply(items=[
-            QuickReplyButton(action=MessageAction(label="🔧 แจ้งซ่อม", text="แจ้งซ่อม")),
-            QuickReplyButton(action=MessageAction(label="🏢 สั่งซื้อหน่วยงาน", text="สั่งซื้อหน่วยงาน")),
-            QuickReplyButton(action=MessageAction(label="📦 สอบถามสินค้า", text="สอบถามสินค้า")),
-            QuickReplyButton(action=MessageAction(label="ℹ️ ช่วยเหลือ", text="ช่วยเหลือ")),
-            QuickReplyButton(action=MessageAction(label="📍 ติดต่อเรา", text="ติดต่อเรา"))
-        ])
-        greeting_text = "👋 สวัสดีครับ Datacom Service ยินดีให้บริการครับ 😊\nคุณลูกค้าต้องการให้เราดูแลเรื่องไหน สามารถเลือกเมนูด้านล่างได้เลยนะครับ 👇"
-        line_bot_api.reply_message(
+        # ยังไม่มีฐานข้อมูลงานซ่อม ส่งต่อให้แอดมินตามเดิม
+        send_reply(
             event.reply_token,
-            TextSendMessage(text=greeting_text, quick_reply=qr)
+            TextSendMessage(text=f"กำลังตรวจสอบข้อมูลของ: {text}\n(แอดมินจะรีบแจ้งความคืบหน้าให้ทราบโดยเร็วนะครับ)")
         )
 
-# ---------- CHECK STATUS ----------
-def handle_check_status(event, text, user_id):
-    sessions[user_id] = "IDLE"
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=f"กำลังตรวจสอบข้อมูลของ: {text}\n(แอดมินจะรีบแจ้งความคืบหน้าให้ทราบโดยเร็วนะครับ)")
-    )
+def ticket_code_row(ticket_code):
+    # ticket ที่ไม่ได้บันทึก (ไม่มี DB) ไม่มีเลขที่ให้ลูกค้าใช้ตามงาน
+    return [("เลขที่", ticket_code)] if ticket_code else []
 
 # ---------- REPAIR ----------
-def handle_repair(event, text, user_id, state, is_image):
-    if state == "REPAIR_TYPE":
-        user_data[user_id] = {"type": text}
-        sessions[user_id] = "REPAIR_DETAIL"
-        prompt_text = (
-            "📝 รบกวนแจ้งรายละเอียดตามนี้ เพื่อให้ช่างประเมินได้แม่นยำขึ้นนะครับ\n"
-            "- ยี่ห้อ:\n"
-            "- รุ่น:\n"
-            "- อาการที่พบ:\n"
-            "(สามารถพิมพ์รวมกันแล้วส่งมาในข้อความเดียวได้เลยครับ)"
-        )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=prompt_text, quick_reply=cancel_qr()))
-
-    elif state == "REPAIR_DETAIL":
-        user_data[user_id]["detail"] = text
-        sessions[user_id] = "REPAIR_IMAGE"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="📸 หากมีรูปภาพอุปกรณ์หรืออาการเสีย สามารถส่งมาให้ดูได้เลยนะครับ\n(ถ้าไม่มี สามารถกด 'ข้าม' ที่เมนูด้านล่างได้เลยครับ)", quick_reply=skip_image_qr()))
-
-    elif state == "REPAIR_IMAGE":
-        data = user_data.pop(user_id)
-        sessions[user_id] = "IDLE"
-        card = create_summary_flex(
-            "บันทึกแจ้งซ่อม", "#ff9800",
-            [("อุปกรณ์", data["type"]), ("รายละเอียด", data["detail"]), ("รูปภาพ", "มี" if is_image else "ไม่มี"), ("สถานะ", "รอประเมินราคา")],
-            "รับเรื่องเรียบร้อย แอดมินจะติดต่อกลับครับ", "https://github.com/taedate/DATACOM-ImageV2/blob/main/PleaseWaitadminreply2.png?raw=true"
-        )
-        line_bot_api.reply_message(event.reply_token, card)
+def update_repair_details(data, text, is_image):
+    data["turns"] = data.get("turns", 0) + 1
+    if is_image:
+        data["has_image"] = True
+        return {}
+    details = repair_catalog.parse(text)
+    tags = details.pop("tags", [])
+    for field, value in details.items():
+        data.setdefault(field, value)
+    if tags:
+        data["tags"] = data.get("tags", []) + [tag for tag in tags if tag not in data.get("tags", [])]
+    # ข้อความที่มีแค่ประเภทอุปกรณ์ (ปุ่มด่วน) ไม่ต้องเก็บเป็นรายละเอียด
+    if set(details) != {"type"}:
+        data["detail"] = session_text(f"{data['detail']}\n{text}" if data.get("detail") else text)
+    return details
+
+def advance_repair(event, session, is_image):
+    data = session.data
+    if not missing_repair_fields(data):
+        return submit_repair(event, session, is_image)
+    if not data.get("type"):
+        send_reply(event.reply_token, REPAIR_TYPE_PROMPT_REPLY)
+        return "REPAIR_TYPE"
+    fields = tuple(field for field in REPAIR_FIELD_LABELS if not data.get(field))
+    send_reply(event.reply_token, REPAIR_DETAIL_PROMPT_REPLY if len(fields) == len(REPAIR_FIELD_LABELS) else repair_missing_reply(fields))
+    return "REPAIR_DETAIL"
+
+@router.state("REPAIR_TYPE")
+def handle_repair_type(event, text, session, is_image):
+    # ตอบเป็นปุ่มประเภท หรือพิมพ์ ยี่ห้อ/รุ่น/อาการ มาเลยก็ได้
+    if not update_repair_details(session.data, text, is_image) and not is_image:
+        session.data["type"] = text
+    return advance_repair(event, session, is_image)
+
+@router.state("REPAIR_DETAIL", next_state="REPAIR_IMAGE")
+def handle_repair_detail(event, text, session, is_image):
+    # ถามรายละเอียดไปแล้ว ไปขั้นรูปภาพตามเดิม ที่ยังขาดให้แอดมินอ่านจากรายละเอียดเอง
+    update_repair_details(session.data, text, is_image)
+    send_reply(event.reply_token, REPAIR_IMAGE_PROMPT_REPLY)
+
+@router.command("ยืนยันแจ้งซ่อม", state="REPAIR_CONFIRM")
+def handle_repair_confirm(event, text, session, is_image):
+    session.data["turns"] = session.data.get("turns", 0) + 1
+    return submit_repair(event, session, is_image)
+
+@router.state("REPAIR_CONFIRM", kind="image")
+def handle_repair_confirm_image(event, text, session, is_image):
+    update_repair_details(session.data, text, is_image)
+    return submit_repair(event, session, is_image)
+
+@router.state("REPAIR_CONFIRM", kind="text")
+def handle_repair_unconfirmed(event, text, session, is_image):
+    return dispatch_as_idle(event, text, session, is_image)
+
+@router.state("REPAIR_IMAGE")
+def handle_repair(event, text, session, is_image):
+    session.data["turns"] = session.data.get("turns", 0) + 1
+    return submit_repair(event, session, is_image)
+
+def submit_repair(event, session, is_image):
+    data, session.data = session.data, {}
+    repair_turns.add(data.pop("turns", 1))
+    has_image = data.pop("has_image", False) or is_image
+    submission_counter.add(business_schedule.now())
+    ticket_code = create_ticket("repair", event.source.user_id, data, has_image)
+    items = ticket_code_row(ticket_code) + [("อุปกรณ์", data.get("type", "-"))]
+    if data.get("brand") or data.get("model"):
+        items.append(("ยี่ห้อ/รุ่น", " ".join(data[field] for field in ("brand", "model") if data.get(field))))
+    items.append(("อาการ", data["symptom"]) if data.get("symptom") else ("รายละเอียด", data.get("detail", "-")))
+    items.append(("รูปภาพ", "มี" if has_image else "ไม่มี"))
+    device_type, brand, _, tags = repair_columns(data)
+    estimate = repair_estimates.estimate(device_type, brand, tags) if repair_estimates else None
+    items.append(("ราคาประเมิน", format_estimate(estimate)) if estimate else ("สถานะ", "รอประเมินราคา"))
+    card = create_summary_flex(
+        "บันทึกแจ้งซ่อม", "#ff9800", items,
+        "รับเรื่องเรียบร้อย แอดมินจะติดต่อกลับครับ", "https://github.com/taedate/DATACOM-ImageV2/blob/main/PleaseWaitadminreply2.png?raw=true"
+    )
+    send_reply(event.reply_token, card)
+    return "IDLE"
 
 # ---------- ORG ----------
-def handle_org(event, text, user_id, state, is_image):
-    if state == "ORG_DETAIL":
-        user_data[user_id] = {"detail": text}
-        sessions[user_id] = "ORG_IMAGE"
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="📸 หากมีรูปภาพตัวอย่างสินค้า สามารถส่งมาได้เลยนะครับ\n(ถ้าไม่มี สามารถกด 'ข้าม' ที่เมนูด้านล่างได้เลยครับ)", quick_reply=skip_image_qr())
-        )
+@router.state("ORG_DETAIL", next_state="ORG_IMAGE")
+def handle_org_detail(event, text, session, is_image):
+    session.data = {"detail": session_text(text)}
+    send_reply(event.reply_token, ORG_IMAGE_PROMPT_REPLY)
 
-    elif state == "ORG_IMAGE":
-        data = user_data.pop(user_id)
-        sessions[user_id] = "IDLE"
-
-        card = create_summary_flex(
-            "คำสั่งซื้อหน่วยงาน", "#1976d2",
-            [
-                ("รายละเอียด", data["detail"]),
-                ("รูปภาพ", "มี" if is_image else "ไม่มี"),
-                ("สถานะ", "รอตรวจสอบสต็อก")
-            ],
-            "รับเรื่องเรียบร้อย แอดมินจะจัดส่งใบเสนอราคาให้ครับ",
-            "https://github.com/taedate/DATACOM-ImageV2/blob/main/PleaseWaitadminreply2.png?raw=true"
-        )
-        line_bot_api.reply_message(event.reply_token, card)
+@router.state("ORG_IMAGE", next_state="IDLE")
+def handle_org(event, text, session, is_image):
+    data, session.data = session.data, {}
+    ticket_code = create_ticket("org", event.source.user_id, data, is_image)
+    card = create_summary_flex(
+        "คำสั่งซื้อหน่วยงาน", "#1976d2",
+        ticket_code_row(ticket_code) + [
+            ("รายละเอียด", data["detail"]),
+            ("รูปภาพ", "มี" if is_image else "ไม่มี"),
+            ("สถานะ", "รอตรวจสอบสต็อก")
+        ],
+        "รับเรื่องเรียบร้อย แอดมินจะจัดส่งใบเสนอราคาให้ครับ",
+        "https://github.com/taedate/DATACOM-ImageV2/blob/main/PleaseWaitadminreply2.png?raw=true"
+    )
+    send_reply(event.reply_token, card)
 
 # ---------- INQUIRY ----------
-def handle_inquiry(event, text, user_id, state, is_image):
-    if state == "INQUIRY_PRODUCT":
-        user_data[user_id] = {"product": text}
-        sessions[user_id] = "INQUIRY_IMAGE"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="📸 มีรูปภาพสินค้าตัวอย่างไหมครับ?\n(ถ้าไม่มี สามารถกด 'ข้าม' ที่เมนูด้านล่างได้เลยครับ)", quick_reply=skip_image_qr()))
-
-    elif state == "INQUIRY_IMAGE":
-        data = user_data.pop(user_id)
-        sessions[user_id] = "IDLE"
-        card = create_summary_flex(
-            "สอบถามสินค้า", "#9c27b0",
-            [("สินค้า", data["product"]), ("รูปภาพ", "มี" if is_image else "ไม่มี"), ("สถานะ", "รอแอดมินตอบ")],
-            "ระบบได้รับข้อความแล้ว กำลังเรียกแอดมินครับ", "https://github.com/taedate/DATACOM-ImageV2/blob/main/PleaseWaitadminreply2.png?raw=true"
-        )
-        line_bot_api.reply_message(event.reply_token, card)
+@router.state("INQUIRY_PRODUCT", next_state="INQUIRY_IMAGE")
+def handle_inquiry_product(event, text, session, is_image):
+    session.data = {"product": session_text(text)}
+    send_reply(event.reply_token, INQUIRY_IMAGE_PROMPT_REPLY)
+
+@router.state("INQUIRY_IMAGE", next_state="IDLE")
+def handle_inquiry(event, text, session, is_image):
+    data, session.data = session.data, {}
+    ticket_code = create_ticket("inquiry", event.source.user_id, data, is_image)
+    card = create_summary_flex(
+        "สอบถามสินค้า", "#9c27b0",
+        ticket_code_row(ticket_code) + [("สินค้า", data["product"]), ("รูปภาพ", "มี" if is_image else "ไม่มี"), ("สถานะ", "รอแอดมินตอบ")],
+        "ระบบได้รับข้อความแล้ว กำลังเรียกแอดมินครับ", "https://github.com/taedate/DATACOM-ImageV2/blob/main/PleaseWaitadminreply2.png?raw=true"
+    )
+    send_reply(event.reply_token, card)
 
 # ================= HEALTH CHECK / KEEP ALIVE =================
 @app.route("/", methods=["GET"])
 def home():
     return "Bot is awake and running!"
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return jsonify(
+        webhook=webhook_executor.stats(),
+        dedupe=event_deduper.stats(),
+        line_http=line_bot_api.http_client.stats(),
+        sessions=session_store.stats(),
+        imagemap=imagemap_registry.stats(),
+        schedule=business_schedule.stats(),
+        repair_catalog=repair_catalog.stats(),
+        repair_turns=repair_turns.stats(),
+        repair_estimates=repair_estimates.stats() if repair_estimates else None,
+        tickets=ticket_writer.stats() if ticket_writer else None,
+        ticket_codes=ticket_codes.stats() if ticket_codes else None,
+        status_cache=status_cache.stats() if status_cache else None,
+        job_bloom=job_bloom.stats() if job_bloom else None,
+        notifications=status_notifier.stats() if status_notifier else None,
+        help_badges=help_badges.stats() if help_badges else None,
+    )
+
 # ================= RUN =================
 if __name__ == "__main__":
+    if "--routes" in sys.argv:
+        for state, trigger, handler_name, next_state in router.transition_table():
+            print(f"{state:<16} {trigger:<24} {handler_name:<28} -> {next_state or '(same)'}")
+        sys.exit(0)
+    if "--init-db" in sys.argv:
+        init_db()
+        print("Database schema is up to date")
+        sys.exit(0)
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
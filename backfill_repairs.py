@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import argparse
+
+# ใช้แค่ส่วน DB และ RepairCatalog ของแอป ไม่ต้อง render รูปหรือเปิด connection ไป LINE
+os.environ.setdefault("IMAGEMAP_PRERENDER", "0")
+os.environ.setdefault("HELP_BADGES", "0")
+os.environ.setdefault("LINE_HTTP_WARM", "0")
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from app import DATABASE_URL, db_connection, repair_columns, structure_repair
+
+def backfill_repairs(batch_size=5000, reparse=False):
+    # เดินตาม id ทีละก้อนแล้ว commit ทุกก้อน ล็อกแถวสั้นๆ หยุดกลางทางแล้วรันต่อได้
+    started = time.perf_counter()
+    condition = "kind = 'repair'" if reparse else "kind = 'repair' AND symptom_tags IS NULL"
+    last_id, scanned, structured = -1, 0, 0
+    while True:
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT id, data FROM tickets WHERE {condition} AND id > %s ORDER BY id LIMIT %s", (last_id, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            values = []
+            for ticket_id, data in rows:
+                columns = repair_columns(structure_repair(data))
+                values.append((ticket_id, *columns))
+                if any(columns[:3]) or columns[3]:
+                    structured += 1
+            execute_values(
+                cur,
+                "UPDATE tickets AS t SET device_type = v.device_type, brand = v.brand, model = v.model, symptom_tags = v.symptom_tags "
+                "FROM (VALUES %s) AS v (id, device_type, brand, model, symptom_tags) WHERE t.id = v.id",
+                values, template="(%s, %s, %s, %s, %s::text[])", page_size=len(values)
+            )
+        last_id = rows[-1][0]
+        scanned += len(rows)
+        if scanned % 100000 < len(rows):
+            print(f"-> {scanned} tickets")
+    return {"scanned": scanned, "structured": structured, "seconds": time.perf_counter() - started}
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill brand/model/device_type/symptom_tags of repair tickets from their free text")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--reparse", action="store_true", help="re-read every repair ticket, e.g. after editing repair_catalog.json")
+    args = parser.parse_args()
+
+    if not DATABASE_URL:
+        print("-> Error: ต้องตั้งค่า DATABASE_URL ก่อน")
+        sys.exit(1)
+    print("Backfilling repair tickets...")
+    try:
+        result = backfill_repairs(args.batch_size, args.reparse)
+    except psycopg2.Error as e:
+        print(f"-> Error: {e}")
+        sys.exit(1)
+    rate = result["scanned"] / result["seconds"] if result["seconds"] else 0
+    print(f"-> {result['scanned']} tickets in {result['seconds']:.1f}s ({rate:.0f} tickets/s)")
+    print(f"-> {result['structured']} with brand, model, type or symptom tags")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+import io
+import os
+import json
+import hmac
+import base64
+import hashlib
+import time
+import timeit
+import warnings
+import multiprocessing
+
+os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "benchmark-token")
+os.environ.setdefault("CHANNEL_SECRET", "benchmark-secret")
+warnings.filterwarnings("ignore")
+
+import app
+
+def per_call_us(func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    return best / number * 1_000_000
+
+def sign(body):
+    secret = os.environ["CHANNEL_SECRET"].encode("utf-8")
+    return base64.b64encode(hmac.new(secret, body, hashlib.sha256).digest()).decode("utf-8")
+
+# ================= WEBHOOK DECODER =================
+def make_webhook_body(count):
+    events = []
+    for i in range(count):
+        events.append({
+            "type": "message",
+            "mode": "active",
+            "timestamp": 1700000000000 + i,
+            "source": {"type": "user", "userId": f"U{i:032x}"},
+            "webhookEventId": f"01HEVENT{i:018d}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"{i:032x}",
+            "message": {"type": "text", "id": str(480000000000 + i), "quoteToken": "q" * 40, "text": "แจ้งซ่อม"},
+        })
+    return json.dumps({"destination": "U" + "0" * 32, "events": events}, ensure_ascii=False).encode("utf-8")
+
+def bench_webhook_decoder():
+    from linebot.webhook import WebhookParser
+
+    parser = WebhookParser(os.environ["CHANNEL_SECRET"])
+    print("Webhook decode (signature check + parse), µs per payload")
+    print(f"{'events':>8} {'sdk':>12} {'slotted':>12} {'speedup':>9}")
+    for count in (1, 10, 100):
+        body = make_webhook_body(count)
+        signature = sign(body)
+        number = max(10, 2000 // count)
+
+        def sdk():
+            parser.parse(body.decode("utf-8"), signature)
+
+        def slotted():
+            app.verify_signature(body, signature)
+            app.decode_webhook(body)
+
+        sdk_us = per_call_us(sdk, number)
+        slotted_us = per_call_us(slotted, number)
+        print(f"{count:>8} {sdk_us:>12.1f} {slotted_us:>12.1f} {sdk_us / slotted_us:>8.1f}x")
+
+# ================= FLEX TEMPLATE =================
+def legacy_summary_flex(title, color, items, footer_text, image_url=None):
+    # ตัวสร้างการ์ดแบบเดิม (SDK object tree) ไว้เทียบ
+    from linebot.models import BubbleContainer, BoxComponent, TextComponent, SeparatorComponent, ImageComponent, FlexSendMessage
+
+    body_contents = [
+        TextComponent(text=title, weight='bold', size='lg', wrap=True),
+        SeparatorComponent(margin='md')
+    ]
+    for label, value in items:
+        body_contents.append(
+            BoxComponent(
+                layout='baseline', spacing='sm', margin='md',
+                contents=[
+                    TextComponent(text=label, color='#aaaaaa', size='sm', flex=2),
+                    TextComponent(text=value, wrap=True, color='#666666', size='sm', flex=5)
+                ]
+            )
+        )
+    footer = BoxComponent(
+        layout='vertical', margin='lg',
+        contents=[
+            SeparatorComponent(),
+            TextComponent(text=footer_text, color='#aaaaaa', size='xs', align='center', margin='md')
+        ]
+    )
+    bubble = BubbleContainer(
+        hero=ImageComponent(url=image_url, size='full', aspect_ratio='4:3', aspect_mode='cover') if image_url else None,
+        body=BoxComponent(layout='vertical', paddingAll='lg', contents=body_contents),
+        footer=footer
+    )
+    return FlexSendMessage(alt_text=title, contents=bubble)
+
+def bench_summary_card():
+    args = (
+        "บันทึกแจ้งซ่อม", "#ff9800",
+        [("อุปกรณ์", "ปริ้นเตอร์"), ("รายละเอียด", "ยี่ห้อ: HP\nรุ่น: LaserJet P1102\nอาการ: กระดาษติด \"ไฟกะพริบ\""), ("รูปภาพ", "มี"), ("สถานะ", "รอประเมินราคา")],
+        "รับเรื่องเรียบร้อย แอดมินจะติดต่อกลับครับ",
+        "https://github.com/taedate/DATACOM-ImageV2/blob/main/PleaseWaitadminreply2.png?raw=true",
+    )
+    assert json.loads(app.create_summary_flex(*args).body) == [legacy_summary_flex(*args).as_json_dict()]
+
+    def before():
+        app.encode_json([legacy_summary_flex(*args).as_json_dict()])
+
+    def after():
+        app.create_summary_flex(*args)
+
+    before_us = per_call_us(before, 2000)
+    after_us = per_call_us(after, 2000)
+    print("Summary card build + encode, µs per card")
+    print(f"{'sdk tree':>12} {'template':>12} {'speedup':>9}")
+    print(f"{before_us:>12.1f} {after_us:>12.1f} {before_us / after_us:>8.1f}x")
+    print(f"template worst-case size: {app.SUMMARY_CARD_TEMPLATE.max_size} / {app.FLEX_BUBBLE_MAX_BYTES} bytes")
+
+# ================= SHARED-MEMORY SESSIONS =================
+def _shm_session_worker(name, ops, users, seed, results):
+    import random
+
+    store = app.SharedMemorySessionStore(name, 16384, 1024, 64, 3600, 0)
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    for _ in range(ops):
+        session = store.load(f"U{rng.randrange(users):032x}")
+        session.state = "REPAIR_DETAIL"
+        session.data = {"type": "คอมพิวเตอร์"}
+        store.save(session)
+    results.put((time.perf_counter() - started, store.lock_wait))
+
+def bench_shm_sessions(ops=20000, users=5000):
+    ctx = multiprocessing.get_context("fork")
+    name = f"datacom_bench_{os.getpid()}"
+    store = app.SharedMemorySessionStore(name, 16384, 1024, 64, 3600, 0)
+    print(f"Shared-memory session table, {ops} load+save per worker, {users} users")
+    print(f"{'workers':>8} {'ops/s':>12} {'lock wait/op':>14}")
+    try:
+        for workers in (1, 2, 4, 8, 16):
+            results = ctx.Queue()
+            procs = [ctx.Process(target=_shm_session_worker, args=(name, ops, users, i, results)) for i in range(workers)]
+            started = time.perf_counter()
+            for p in procs:
+                p.start()
+            stats = [results.get() for _ in procs]
+            for p in procs:
+                p.join()
+            elapsed = time.perf_counter() - started
+            wait_us = sum(w for _, w in stats) / (workers * ops * 2) * 1_000_000
+            print(f"{workers:>8} {workers * ops / elapsed:>12.0f} {wait_us:>11.1f} µs")
+    finally:
+        store.destroy()
+
+# ================= IMAGEMAP ROUTE =================
+def legacy_imagemap(size):
+    # route แบบเดิม: เปิดไฟล์ ย่อ และ encode ใหม่ทุกครั้ง
+    from PIL import Image
+
+    img = Image.open(app.imagemap_registry.get("help").renditions.path)
+    height = int(img.height * size / img.width)
+    img_io = io.BytesIO()
+    img.resize((size, height), Image.Resampling.LANCZOS).save(img_io, "PNG", quality=85)
+    return img_io.getvalue()
+
+def percentiles_ms(func, count):
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99) - 1]
+
+def bench_imagemap_route(count=200):
+    client = app.app.test_client()
+    app.imagemap_registry.warm()
+    print(f"Imagemap fetch, {count} requests per size, ms")
+    print(f"{'size':>6} {'legacy p50':>11} {'legacy p99':>11} {'cached p50':>11} {'cached p99':>11}")
+    for size in app.IMAGEMAP_SIZES:
+        legacy = percentiles_ms(lambda: legacy_imagemap(size), max(10, count // 10))
+        cached = percentiles_ms(lambda: client.get(f"/imagemap/help/{size}"), count)
+        print(f"{size:>6} {legacy[0]:>11.2f} {legacy[1]:>11.2f} {cached[0]:>11.3f} {cached[1]:>11.3f}")
+
+# ================= TICKETS =================
+def _submit_in_threads(func, rows, threads):
+    import threading
+
+    per_thread = rows // threads
+    workers = [threading.Thread(target=lambda: [func() for _ in range(per_thread)]) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads, started
+
+def bench_tickets(rows=20000, threads=8):
+    if not app.DATABASE_URL:
+        print("Tickets: DATABASE_URL is not set, skipped")
+        return
+    app.init_db()
+    data = {"type": "ปริ้นเตอร์", "detail": "ยี่ห้อ: HP\nรุ่น: LaserJet P1102\nอาการ: กระดาษติด"}
+    print(f"Ticket inserts, {threads} submitting threads")
+    print(f"{'mode':>14} {'rows':>7} {'rows/s':>10} {'commit p50':>11} {'commit p99':>11} {'wait p99':>10}")
+    try:
+        commit_times = []
+
+        def single():
+            started = time.perf_counter()
+            with app.db_connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO tickets (id, kind, user_id, data, has_image) VALUES (%s, %s, %s, %s, %s)",
+                    (app.ticket_ids.next(), "repair", "Ubenchmark", app.Json(data), False)
+                )
+            commit_times.append(time.perf_counter() - started)
+
+        count, started = _submit_in_threads(single, rows // 10, threads)
+        elapsed = time.perf_counter() - started
+        p50, p99 = (app.percentile_ms(commit_times, f) for f in (0.5, 0.99))
+        print(f"{'row-at-a-time':>14} {count:>7} {count / elapsed:>10.0f} {p50:>8.2f} ms {p99:>8.2f} ms {p99:>7.2f} ms")
+
+        writer = app.TicketWriter(app.TICKET_BATCH_SIZE, app.TICKET_FLUSH_MS / 1000, rows)
+        count, started = _submit_in_threads(lambda: writer.submit(app.ticket_ids.next(), None, "repair", "Ubenchmark", data, False), rows, threads)
+        writer.join()
+        elapsed = time.perf_counter() - started
+        stats = writer.stats()
+        print(f"{'group commit':>14} {count:>7} {count / elapsed:>10.0f} {stats['commit_ms_p50']:>8.2f} ms {stats['commit_ms_p99']:>8.2f} ms {stats['wait_ms_p99']:>7.2f} ms")
+        print(f"rows per commit: {stats['rows_per_commit']}")
+    finally:
+        with app.db_connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM tickets WHERE user_id = 'Ubenchmark'")
+
+# ================= JOB LOOKUP =================
+def bench_job_lookup(rows=1_000_000, lookups=2000):
+    import random
+
+    if not app.DATABASE_URL:
+        print("Job lookup: DATABASE_URL is not set, skipped")
+        return
+    app.init_db()
+    phones = rows // 3
+    with app.db_connection() as conn, conn.cursor() as cur:
+        # รหัสงาน ZZ... และเบอร์ 09... ใช้เฉพาะ benchmark ลบทิ้งตอนจบ
+        cur.execute(
+            "INSERT INTO jobs (job_code, phone, device, status, received_at, updated_at) "
+            "SELECT 'ZZ' || lpad(i::text, 7, '0'), '09' || lpad((i %% %s)::text, 8, '0'), 'ปริ้นเตอร์', 'ซ่อมเสร็จ', now(), now() - i * interval '1 minute' "
+            "FROM generate_series(1, %s) AS i ON CONFLICT DO NOTHING",
+            (phones, rows)
+        )
+        cur.execute("ANALYZE jobs")
+    rng = random.Random(1)
+    print(f"Job status lookup over {rows} jobs, {lookups} lookups each, ms")
+    print(f"{'by':>6} {'p50':>8} {'p99':>8} {'card p99':>9}")
+    try:
+        for kind in ("job", "phone"):
+            queries, cards = [], []
+            for _ in range(lookups):
+                i = rng.randrange(1, rows + 1)
+                _, value = app.normalize_lookup(f"ZZ-{i:07d}" if kind == "job" else f"๐๙{i % phones:08d}")
+                started = time.perf_counter()
+                jobs = app.find_jobs(kind, value)
+                queries.append(time.perf_counter() - started)
+                app.create_job_status_flex(jobs)
+                cards.append(time.perf_counter() - started)
+            p50, p99 = (app.percentile_ms(queries, f) for f in (0.5, 0.99))
+            print(f"{kind:>6} {p50:>8.3f} {p99:>8.3f} {app.percentile_ms(cards, 0.99):>9.3f}")
+    finally:
+        with app.db_connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM jobs WHERE job_code LIKE 'ZZ%'")
+
+# ================= REPAIR TURNS =================
+# (ปุ่มประเภท, ข้อความรายละเอียด, ลูกค้าพิมพ์รายละเอียดมาเลยแทนการกดปุ่มประเภท)
+REPAIR_CUSTOMERS = [
+    ("ปริ้นเตอร์", "ยี่ห้อ: HP\nรุ่น: LaserJet P1102\nอาการ: กระดาษติด", True),
+    ("ปริ้นเตอร์", "canon g2010 หมึกไม่ออก ไฟกระพริบสลับ", True),
+    ("คอมพิวเตอร์", "โน๊ตบุ๊ค acer aspire 5 เปิดไม่ติด", True),
+    ("คอมพิวเตอร์", "ยี่ห้อ HP อาการ เครื่องช้ามาก", True),
+    ("อุปกรณ์อื่น", "ups apc สำรองไฟไม่ได้", True),
+    ("คอมพิวเตอร์", "ยี่ห้อ lenovo รุ่น ideapad อาการ จอดำ", False),
+    ("ปริ้นเตอร์", "epson l3110 พิมพ์เป็นเส้น", False),
+    ("คอมพิวเตอร์", "เครื่องมีปัญหา เปิดมาสักพักแล้วดับ", False),
+]
+
+def legacy_repair_router():
+    # flow แจ้งซ่อมเดิม: ถามประเภท > รายละเอียด > รูป ทุกครั้งไม่ว่าลูกค้าพิมพ์อะไรมา
+    router = app.CommandRouter()
+
+    @router.command("แจ้งซ่อม", next_state="REPAIR_TYPE")
+    def start_repair(event, text, session, is_image):
+        app.send_reply(event.reply_token, app.REPAIR_TYPE_PROMPT_REPLY)
+
+    @router.state("REPAIR_TYPE", next_state="REPAIR_DETAIL")
+    def handle_repair_type(event, text, session, is_image):
+        session.data = {"type": text}
+        app.send_reply(event.reply_token, app.REPAIR_DETAIL_PROMPT_REPLY)
+
+    @router.state("REPAIR_DETAIL", next_state="REPAIR_IMAGE")
+    def handle_repair_detail(event, text, session, is_image):
+        session.data["detail"] = text
+        app.send_reply(event.reply_token, app.REPAIR_IMAGE_PROMPT_REPLY)
+
+    @router.state("REPAIR_IMAGE", next_state="IDLE")
+    def handle_repair(event, text, session, is_image):
+        data, session.data = session.data, {}
+        app.create_ticket("repair", event.source.user_id, data, is_image)
+
+    return router
+
+def repair_turns(router, button, detail, pastes):
+    # ลูกค้าจำลองตอบตาม state ที่ bot ถาม นับข้อความจนได้ ticket
+    from types import SimpleNamespace
+
+    session = app.Session("Ubenchmark")
+    event = SimpleNamespace(reply_token="0" * 32, source=SimpleNamespace(user_id="Ubenchmark"))
+    messages = ["แจ้งซ่อม"]
+    while True:
+        router.dispatch(event, messages[-1], session, False)
+        if session.state == "IDLE":
+            return len(messages)
+        if session.state == "REPAIR_TYPE":
+            messages.append(detail if pastes and len(messages) == 1 else button)
+        elif session.state == "REPAIR_DETAIL":
+            messages.append(detail)
+        else:
+            messages.append("ข้าม")
+
+def bench_repair_turns():
+    send_reply, create_ticket = app.send_reply, app.create_ticket
+    app.send_reply = lambda reply_token, reply: None
+    app.create_ticket = lambda kind, user_id, data, has_image: "DC-0000-0"
+    try:
+        flows = {
+            "legacy": [repair_turns(legacy_repair_router(), *customer) for customer in REPAIR_CUSTOMERS],
+            "one-shot": [repair_turns(app.router, *customer) for customer in REPAIR_CUSTOMERS],
+        }
+    finally:
+        app.send_reply, app.create_ticket = send_reply, create_ticket
+    print(f"Repair submission, {len(REPAIR_CUSTOMERS)} scripted customers")
+    print(f"{'flow':>10} {'avg turns':>10} {'min':>5} {'max':>5}")
+    for flow, turns in flows.items():
+        print(f"{flow:>10} {sum(turns) / len(turns):>10.2f} {min(turns):>5} {max(turns):>5}")
+    for _, detail, _ in REPAIR_CUSTOMERS[:3]:
+        print(f"parse {per_call_us(lambda: app.repair_catalog.parse(detail), 2000):7.1f} µs  {detail.splitlines()[0][:30]}")
+
+def bench_repair_estimate(keys=20000):
+    from types import SimpleNamespace
+
+    estimates = app.RepairCostEstimates(refresh_interval=3600)
+    # ตารางจำลองขนาดใหญ่กว่าของจริง ไม่ต้องเริ่ม thread โหลดจาก DB
+    estimates._pid = os.getpid()
+    brands = ["HP", "Canon", "Epson", "Acer", "Lenovo"] + [f"B{i}" for i in range(keys // 100)]
+    tags = list(app.repair_catalog.symptom_labels)
+    for i in range(keys):
+        estimates._table[("ปริ้นเตอร์", brands[i % len(brands)], tags[i % len(tags)])] = (800, 1800, 120 + i)
+    data = {"type": "ปริ้นเตอร์", "brand": "HP", "model": "LaserJet P1102", "symptom": "กระดาษติด", "tags": ["paper_jam"], "detail": "HP P1102 กระดาษติด"}
+    event = SimpleNamespace(reply_token="0" * 32, source=SimpleNamespace(user_id="Ubenchmark"))
+    send_reply, create_ticket, current = app.send_reply, app.create_ticket, app.repair_estimates
+    app.send_reply = lambda reply_token, reply: None
+    app.create_ticket = lambda kind, user_id, data, has_image: "DC-0000-0"
+
+    def submit():
+        app.submit_repair(event, app.Session("Ubenchmark", data=dict(data)), False)
+
+    try:
+        app.repair_estimates = None
+        before_us = per_call_us(submit, 2000)
+        app.repair_estimates = estimates
+        after_us = per_call_us(submit, 2000)
+    finally:
+        app.send_reply, app.create_ticket, app.repair_estimates = send_reply, create_ticket, current
+    print(f"Repair card with cost estimate, {len(estimates._table)} estimate keys, µs per ticket")
+    print(f"{'no estimate':>12} {'estimate':>12} {'added':>9}")
+    print(f"{before_us:>12.1f} {after_us:>12.1f} {after_us - before_us:>9.1f}")
+
+if __name__ == "__main__":
+    bench_webhook_decoder()
+    print()
+    bench_summary_card()
+    print()
+    bench_shm_sessions()
+    print()
+    bench_imagemap_route()
+    print()
+    bench_tickets()
+    print()
+    bench_job_lookup()
+    print()
+    bench_repair_turns()
+    print()
+    bench_repair_estimate()
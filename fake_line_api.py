@@ -0,0 +1,70 @@
+import sys
+import time
+import random
+import threading
+from flask import Flask, request, jsonify
+
+# LINE Messaging API ปลอมสำหรับทดสอบในเครื่อง
+# รัน: python fake_line_api.py [port] แล้วตั้ง LINE_API_ENDPOINT=http://127.0.0.1:8089 ให้แอป
+# ดูข้อความที่ได้รับ: GET /__sent, ล้าง: DELETE /__sent
+
+app = Flask(__name__)
+
+# จำลองความช้าและ rate limit ของ LINE (ตั้งผ่าน POST /__config)
+config = {"latency_ms": 20, "fail_rate": 0.0}
+sent = []
+lock = threading.Lock()
+
+MAX_RECIPIENTS = {"push": 1, "multicast": 500}
+
+def record(kind, payload):
+    with lock:
+        sent.append({"kind": kind, "payload": payload, "at": time.time()})
+    to = payload.get("to")
+    count = len(to) if isinstance(to, list) else 1
+    print(f"-> {kind}: {count} recipient(s), {len(payload.get('messages', []))} message(s)")
+
+@app.route("/v2/bot/message/<kind>", methods=["POST"])
+def message(kind):
+    time.sleep(config["latency_ms"] / 1000)
+    if random.random() < config["fail_rate"]:
+        return jsonify(message="The API rate limit has been exceeded. Try again later."), 429, {"Retry-After": "1"}
+    payload = request.get_json(force=True)
+    messages = payload.get("messages") or []
+    if not 1 <= len(messages) <= 5:
+        return jsonify(message="Size must be between 1 and 5"), 400
+    if kind == "reply":
+        if not payload.get("replyToken"):
+            return jsonify(message="Invalid reply token"), 400
+    elif kind in MAX_RECIPIENTS:
+        to = payload.get("to")
+        if kind == "multicast" and (not isinstance(to, list) or not 1 <= len(to) <= MAX_RECIPIENTS[kind]):
+            return jsonify(message=f"Size must be between 1 and {MAX_RECIPIENTS[kind]}"), 400
+        if kind == "push" and not isinstance(to, str):
+            return jsonify(message="The property, 'to', in the request body is invalid"), 400
+    else:
+        return jsonify(message="Not found"), 404
+    record(kind, payload)
+    return jsonify({})
+
+@app.route("/v2/bot/info", methods=["GET", "HEAD"])
+def bot_info():
+    return jsonify(userId="U" + "0" * 32, basicId="@fake", displayName="Fake Datacom")
+
+@app.route("/__sent", methods=["GET", "DELETE"])
+def sent_messages():
+    with lock:
+        if request.method == "DELETE":
+            sent.clear()
+            return jsonify({})
+        return jsonify(sent)
+
+@app.route("/__config", methods=["POST"])
+def set_config():
+    config.update({key: float(value) for key, value in request.get_json(force=True).items() if key in config})
+    return jsonify(config)
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8089
+    print(f"Fake LINE API on http://127.0.0.1:{port}")
+    app.run(host="127.0.0.1", port=port, threaded=True)
@@ -0,0 +1,161 @@
+import os
+import io
+import csv
+import sys
+import time
+import argparse
+from datetime import datetime
+
+# ใช้แค่ส่วน DB และตัว normalize ของแอป ไม่ต้อง render รูปหรือเปิด connection ไป LINE
+os.environ.setdefault("IMAGEMAP_PRERENDER", "0")
+os.environ.setdefault("HELP_BADGES", "0")
+os.environ.setdefault("LINE_HTTP_WARM", "0")
+
+from app import business_schedule, db_connection, normalize_lookup
+
+COLUMNS = ("job_code", "phone", "device", "status", "received_at", "updated_at")
+REQUIRED = ("job_code", "status")
+
+class CsvCopyStream:
+    # อ่าน CSV ทีละแถว แปลงแล้วป้อนให้ COPY ทีละก้อน หน่วยความจำคงที่ไม่ว่าไฟล์ใหญ่แค่ไหน
+    def __init__(self, reader, mapping, date_format=None, buddhist_year=False):
+        self.reader = reader
+        self.mapping = mapping
+        self.date_format = date_format
+        self.buddhist_year = buddhist_year
+        self.read_rows = 0
+        self.rejected = 0
+        self.staged = 0
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._done = False
+
+    def _parse_date(self, value):
+        if not value or not self.date_format:
+            return value or None
+        moment = datetime.strptime(value, self.date_format)
+        if self.buddhist_year:
+            moment = moment.replace(year=moment.year - 543)
+        # เวลาใน export ของ POS เป็นเวลาร้าน ใส่ offset ให้ชัด ไม่ให้ timestamptz ตีความเป็น UTC
+        if moment.tzinfo is None:
+            moment = business_schedule.tz.localize(moment)
+        return moment.isoformat()
+
+    def _convert(self, row):
+        values = {column: (row.get(source) or "").strip() for column, source in self.mapping.items()}
+        if any(not values[column] for column in REQUIRED):
+            raise ValueError("missing job_code or status")
+        kind, job_code = normalize_lookup(values["job_code"])
+        if kind != "job":
+            raise ValueError(f"bad job code {values['job_code']!r}")
+        phone = None
+        if values.get("phone"):
+            kind, phone = normalize_lookup(values["phone"])
+            if kind != "phone":
+                phone = None
+        return (
+            job_code, phone, values.get("device") or None, values["status"],
+            self._parse_date(values.get("received_at")), self._parse_date(values.get("updated_at"))
+        )
+
+    def read(self, size=65536):
+        while self._buffer.tell() < size and not self._done:
+            row = next(self.reader, None)
+            if row is None:
+                self._done = True
+                break
+            self.read_rows += 1
+            try:
+                self._writer.writerow(self._convert(row))
+                self.staged += 1
+            except ValueError as e:
+                self.rejected += 1
+                if self.rejected <= 10:
+                    print(f"-> Skipping line {self.reader.line_num}: {e}")
+            if self.read_rows % 100000 == 0:
+                print(f"-> {self.read_rows} rows read")
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+def import_jobs(path, mapping, encoding="utf-8-sig", delimiter=",", date_format=None, buddhist_year=False):
+    started = time.perf_counter()
+    with open(path, newline="", encoding=encoding) as f:
+        stream = CsvCopyStream(csv.DictReader(f, delimiter=delimiter), mapping, date_format, buddhist_year)
+        with db_connection() as conn, conn.cursor() as cur:
+            # วันที่ที่ส่งผ่านไปตรงๆ (ไม่มี --date-format) ก็เป็นเวลาร้านเหมือนกัน มีผลแค่ใน transaction นี้
+            cur.execute("SELECT set_config('TimeZone', %s, true)", (business_schedule.tz.zone,))
+            cur.execute(
+                "CREATE TEMP TABLE jobs_staging (job_code text, phone text, device text, status text, "
+                "received_at timestamptz, updated_at timestamptz) ON COMMIT DROP"
+            )
+            cur.copy_expert(f"COPY jobs_staging ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)", stream)
+            # แถวที่ hash ไม่เปลี่ยนจะไม่ถูก UPDATE (ไม่มี dead tuple และไม่ยิง notify)
+            cur.execute("""
+                WITH upserted AS (
+                    INSERT INTO jobs (job_code, phone, device, status, received_at, updated_at, row_hash)
+                    SELECT DISTINCT ON (job_code)
+                           job_code, phone, device, status, received_at, COALESCE(updated_at, now()),
+                           md5(ROW(phone, device, status, received_at, updated_at)::text)
+                    FROM jobs_staging
+                    ORDER BY job_code, updated_at DESC NULLS LAST
+                    ON CONFLICT (job_code) DO UPDATE SET
+                        phone = EXCLUDED.phone, device = EXCLUDED.device, status = EXCLUDED.status,
+                        received_at = EXCLUDED.received_at, updated_at = EXCLUDED.updated_at, row_hash = EXCLUDED.row_hash
+                    WHERE jobs.row_hash IS DISTINCT FROM EXCLUDED.row_hash
+                    RETURNING xmax = 0 AS inserted
+                )
+                SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted),
+                       (SELECT count(DISTINCT job_code) FROM jobs_staging)
+                FROM upserted
+            """)
+            inserted, updated, distinct = cur.fetchone()
+            # ให้ทุก worker ล้าง cache และสร้าง Bloom filter ใหม่หลัง commit
+            cur.execute("SELECT pg_notify('job_changes', json_build_object('reload', true, 'ts', extract(epoch FROM clock_timestamp()))::text)")
+    elapsed = time.perf_counter() - started
+    return {
+        "read": stream.read_rows,
+        "rejected": stream.rejected,
+        "duplicates": stream.staged - distinct,
+        "inserted": inserted,
+        "updated": updated,
+        "unchanged": distinct - inserted - updated,
+        "seconds": elapsed,
+    }
+
+def parse_mapping(pairs):
+    # ค่าเริ่มต้น: หัวคอลัมน์ใน CSV ชื่อเดียวกับคอลัมน์ในตาราง
+    mapping = {column: column for column in COLUMNS}
+    for pair in pairs:
+        column, _, source = pair.partition("=")
+        if column not in COLUMNS or not source:
+            raise SystemExit(f"Bad --map {pair!r}, expected one of {', '.join(COLUMNS)}=<CSV header>")
+        mapping[column] = source
+    return mapping
+
+def main():
+    parser = argparse.ArgumentParser(description="Import the POS job export (CSV) into the jobs table")
+    parser.add_argument("csv_path")
+    parser.add_argument("--map", action="append", default=[], metavar="COLUMN=HEADER", help="CSV header for a jobs column, e.g. job_code=เลขที่งาน")
+    parser.add_argument("--encoding", default="utf-8-sig", help="use cp874 for Windows Thai exports")
+    parser.add_argument("--delimiter", default=",")
+    parser.add_argument("--date-format", help="strptime format of the date columns, e.g. %%d/%%m/%%Y %%H:%%M")
+    parser.add_argument("--buddhist-year", action="store_true", help="dates in the file use พ.ศ.")
+    args = parser.parse_args()
+
+    print(f"Importing {args.csv_path}...")
+    try:
+        result = import_jobs(
+            args.csv_path, parse_mapping(args.map), args.encoding, args.delimiter, args.date_format, args.buddhist_year
+        )
+    except FileNotFoundError:
+        print(f"-> Error: ไม่พบไฟล์ {args.csv_path}")
+        sys.exit(1)
+    rate = result["read"] / result["seconds"] if result["seconds"] else 0
+    print(f"-> {result['read']} rows in {result['seconds']:.1f}s ({rate:.0f} rows/s)")
+    print(f"-> inserted {result['inserted']}, updated {result['updated']}, unchanged {result['unchanged']}")
+    print(f"-> rejected {result['rejected']}, duplicate job codes {result['duplicates']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+-- ใช้ร่วมกันทุก gunicorn worker: python app.py --init-db
+
+CREATE TABLE IF NOT EXISTS bot_sessions (
+    user_id     text PRIMARY KEY,
+    state       text NOT NULL,
+    data        jsonb NOT NULL DEFAULT '{}'::jsonb,
+    updated_at  timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS bot_sessions_updated_at_idx ON bot_sessions (updated_at);
+
+-- รายการแจ้งซ่อม / สั่งซื้อหน่วยงาน / สอบถามสินค้า (id มาจากแอป ไม่ใช้ sequence)
+CREATE TABLE IF NOT EXISTS tickets (
+    id          bigint PRIMARY KEY,
+    kind        text NOT NULL,
+    user_id     text NOT NULL,
+    data        jsonb NOT NULL DEFAULT '{}'::jsonb,
+    has_image   boolean NOT NULL DEFAULT false,
+    status      text NOT NULL DEFAULT 'received',
+    created_at  timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS tickets_user_id_idx ON tickets (user_id, created_at);
+CREATE INDEX IF NOT EXISTS tickets_open_idx ON tickets (kind) WHERE status = 'received';
+
+-- งานซ่อมจากระบบ POS ใช้ตอบ "ตรวจสอบสถานะงานซ่อม" (phone เก็บแบบ normalize แล้ว เช่น 0812345678)
+CREATE TABLE IF NOT EXISTS jobs (
+    job_code     text PRIMARY KEY,
+    phone        text,
+    device       text,
+    status       text NOT NULL,
+    received_at  timestamptz,
+    updated_at   timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS jobs_phone_idx ON jobs (phone, updated_at DESC);
+
+-- แจ้งทุก worker ให้ลบ cache สถานะของงานที่เปลี่ยน (ดู JobStatusCache ใน app.py)
+CREATE OR REPLACE FUNCTION jobs_notify_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD IS NOT DISTINCT FROM NEW THEN
+        RETURN NULL;
+    END IF;
+    PERFORM pg_notify('job_changes', json_build_object(
+        'job_code', COALESCE(NEW.job_code, OLD.job_code),
+        'phones', json_build_array(NEW.phone, OLD.phone),
+        'status', NEW.status,
+        'old_status', OLD.status,
+        'ts', extract(epoch FROM clock_timestamp())
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS jobs_notify_change ON jobs;
+CREATE TRIGGER jobs_notify_change AFTER INSERT OR UPDATE OR DELETE ON jobs
+    FOR EACH ROW EXECUTE FUNCTION jobs_notify_change();
+
+-- md5 ของแถวตอน import จาก POS ใช้ข้ามแถวที่ไม่เปลี่ยน (import_jobs.py)
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS row_hash text;
+
+-- ผู้ใช้ที่เคยตรวจสถานะงานหรือเป็นผู้แจ้ง ticket จะได้รับแจ้งเมื่องานเปลี่ยนเป็นสถานะใน NOTIFY_STATUSES
+CREATE TABLE IF NOT EXISTS job_watchers (
+    job_code         text NOT NULL,
+    user_id          text NOT NULL,
+    notified_status  text,
+    created_at       timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (job_code, user_id)
+);
+
+-- เลขที่ ticket แบบสั้น (DC-XXXX-C) แต่ละ worker จองเลขทีละช่วงเท่ากับ INCREMENT BY
+-- เปลี่ยนขนาดช่วงได้ด้วย ALTER SEQUENCE ticket_code_seq INCREMENT BY n
+CREATE SEQUENCE IF NOT EXISTS ticket_code_seq START WITH 32768 INCREMENT BY 100;
+ALTER TABLE tickets ADD COLUMN IF NOT EXISTS code text;
+CREATE UNIQUE INDEX IF NOT EXISTS tickets_code_idx ON tickets (code);
+
+-- สถานะ ticket เปลี่ยน ให้ worker ลบ cache ของเลขที่นั้น
+CREATE OR REPLACE FUNCTION tickets_notify_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('job_changes', json_build_object(
+        'job_code', NEW.code,
+        'phones', json_build_array(),
+        'status', NEW.status,
+        'old_status', OLD.status,
+        'ts', extract(epoch FROM clock_timestamp())
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tickets_notify_change ON tickets;
+CREATE TRIGGER tickets_notify_change AFTER UPDATE OF status ON tickets
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status AND NEW.code IS NOT NULL)
+    EXECUTE FUNCTION tickets_notify_change();
+
+-- ข้อมูลแจ้งซ่อมแยกเป็นคอลัมน์ (RepairCatalog ใน app.py) ให้ช่างค้นและสรุปตามยี่ห้อ รุ่น อาการได้
+-- symptom_tags เป็น NULL = ยังไม่ได้แยก ticket เก่าเติมด้วย backfill_repairs.py
+ALTER TABLE tickets ADD COLUMN IF NOT EXISTS device_type text;
+ALTER TABLE tickets ADD COLUMN IF NOT EXISTS brand text;
+ALTER TABLE tickets ADD COLUMN IF NOT EXISTS model text;
+ALTER TABLE tickets ADD COLUMN IF NOT EXISTS symptom_tags text[];
+-- INCLUDE ให้ count/GROUP BY ตามยี่ห้อหรือช่วงเวลาตอบได้จาก index อย่างเดียว (index-only scan)
+CREATE INDEX IF NOT EXISTS tickets_repair_brand_idx ON tickets (brand, model, created_at) INCLUDE (device_type, symptom_tags) WHERE kind = 'repair';
+CREATE INDEX IF NOT EXISTS tickets_repair_created_idx ON tickets (created_at) INCLUDE (device_type, brand, model, symptom_tags) WHERE kind = 'repair';
+CREATE INDEX IF NOT EXISTS tickets_symptom_tags_idx ON tickets USING gin (symptom_tags) WHERE kind = 'repair';
+CREATE INDEX IF NOT EXISTS tickets_repair_backfill_idx ON tickets (id) WHERE kind = 'repair' AND symptom_tags IS NULL;
+
+-- ราคาซ่อมจริงตอนปิดงาน (แอดมิน/POS เป็นคนใส่) ใช้คำนวณช่วงราคาประเมินบนการ์ดแจ้งซ่อม
+ALTER TABLE tickets ADD COLUMN IF NOT EXISTS final_cost numeric(10, 2);
+ALTER TABLE tickets ADD COLUMN IF NOT EXISTS closed_at timestamptz;
+CREATE INDEX IF NOT EXISTS tickets_repair_closed_idx ON tickets (closed_at, id) WHERE kind = 'repair' AND final_cost > 0;
+
+-- ฮิสโตแกรมราคาซ่อม (bucket ละ ~5%) ต่อ (ประเภท, ยี่ห้อ, อาการ) สะสมทีละคืนโดย aggregate_repair_costs.py
+-- brand/symptom_tag เป็น '' = รวมทุกยี่ห้อ/ทุกอาการ
+CREATE TABLE IF NOT EXISTS repair_cost_buckets (
+    device_type  text NOT NULL,
+    brand        text NOT NULL,
+    symptom_tag  text NOT NULL,
+    bucket       integer NOT NULL,
+    samples      integer NOT NULL,
+    PRIMARY KEY (device_type, brand, symptom_tag, bucket)
+);
+
+-- ช่วงราคา p25-p75 ที่แอปโหลดเข้าหน่วยความจำ (RepairCostEstimates ใน app.py)
+CREATE TABLE IF NOT EXISTS repair_cost_estimates (
+    device_type  text NOT NULL,
+    brand        text NOT NULL,
+    symptom_tag  text NOT NULL,
+    samples      integer NOT NULL,
+    low          integer NOT NULL,
+    median       integer NOT NULL,
+    high         integer NOT NULL,
+    updated_at   timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (device_type, brand, symptom_tag)
+);
+
+-- ticket ล่าสุดที่ถูกรวมเข้าฮิสโตแกรมแล้ว รอบถัดไปอ่านต่อจากตรงนี้
+CREATE TABLE IF NOT EXISTS aggregation_watermarks (
+    name        text PRIMARY KEY,
+    closed_at   timestamptz NOT NULL,
+    ticket_id   bigint NOT NULL,
+    updated_at  timestamptz NOT NULL DEFAULT now()
+);
+
+-- worker id ของ snowflake ticket id แต่ละ process จองตอนสร้าง ticket แรก (วน 0-1023)
+CREATE SEQUENCE IF NOT EXISTS ticket_worker_seq MINVALUE 0 MAXVALUE 1023 START WITH 0 CYCLE;